@@ -0,0 +1,403 @@
+"""
+Headless benchmarks of the hot paths, on synthetic projects built through ProjectModel.
+
+- every case is a project of one mask size, layer count and fill density, created in a temp dir
+- scenarios: full frame rendering, scripted brush strokes, a zoom and pan sequence,
+    undo recording and undo, saving one changed layer or all of them, load_project,
+    and the first frame of a project with hidden layers
+- rendering runs the same TileRenderer and ZoomEngine stages as CanvasPainter, only the tk blit is left out
+- every scenario reports its latency distribution in ms and its peak traced memory in MB
+
+    python Benchmark_MaskPainter.py --preset quick --output results.json
+    python Benchmark_MaskPainter.py --output new.json --baseline results.json
+
+With --baseline, the p50 of every scenario is compared with the same case and scenario of an earlier
+result file, and the exit code is 1 if any got slower by more than --tolerance and --min-delta-ms.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import cv2 as cv
+import numpy as np
+
+from src.model.DiskMask import DiskMask
+from src.model.Model import Model
+from src.view.TileRenderer import TileRenderer
+from src.view.ZoomEngine import ZoomEngine
+from src.view.Compositor import Compositor
+from src.view.ExportRenderer import ExportRenderer
+
+
+class HeadlessMaster:
+    # Model only needs the tk root to bind keyboard events and to poll background saves,
+    # the benchmark waits for saves instead
+    def bind(self, *_):
+        pass
+
+    def unbind(self, *_):
+        pass
+
+    def after(self, *_):
+        pass
+
+
+class Benchmark:
+    presets = {
+        "quick": {"sizes": ["640x360", "1920x1080"], "layers": [1, 8], "densities": [0.25]},
+        "default": {"sizes": ["640x360", "1920x1080", "3840x2160"], "layers": [1, 8, 32], "densities": [0.05, 0.5]},
+        "full": {"sizes": ["640x360", "1920x1080", "3840x2160", "7680x4320"], "layers": [1, 8, 64],
+                 "densities": [0.05, 0.5]},
+    }
+    colors = ["#ff0000", "#00ff00", "#0000ff", "#ffff00", "#00ffff", "#ff00ff", "#808080", "#ff8000"]
+
+    def __init__(self, args):
+        self.args = args
+        self.results = []
+
+    def run(self):
+        for size in self.args.sizes:
+            w, h = (int(v) for v in size.split("x"))
+            for num_layers in self.args.layers:
+                for density in self.args.densities:
+                    case = "{}x{}_l{}_d{:g}".format(w, h, num_layers, density)
+                    # masks stored on disk do not count against the memory limit
+                    if w * h * num_layers > self.args.max_mask_bytes and not DiskMask.is_large((h, w)):
+                        print("skip {}: masks are larger than --max-mask-bytes".format(case))
+                        continue
+                    self._run_case(case, w, h, num_layers, density)
+        return self.results
+
+    ###########################################################################
+    #
+    #  cases
+    #
+    ###########################################################################
+
+    def _run_case(self, case, w, h, num_layers, density):
+        print("case {}".format(case))
+        root_dir = tempfile.mkdtemp(prefix="maskpainter_bench_")
+        old_dir = os.getcwd()
+        try:
+            os.chdir(root_dir)
+            model = self._create_project(root_dir, w, h, num_layers, density)
+            self._bench_render(case, model)
+            self._bench_strokes(case, model)
+            self._bench_zoom_pan(case, model)
+            self._bench_undo(case, model)
+            self._bench_export(case, model, root_dir)
+            self._bench_save(case, model)
+            self._bench_load(case, model)
+        finally:
+            os.chdir(old_dir)
+            shutil.rmtree(root_dir, ignore_errors=True)
+
+    def _create_project(self, root_dir, w, h, num_layers, density):
+        # ProjectModel reads the mask size of a new project from the config file in the working dir
+        config = {"default_project_settings": {
+            "mask_width": w, "mask_height": h, "max_background_width": w, "max_background_height": h,
+            "layer_keys": [], "layers": {}, "active_mask": -1, "mask_opaque": True}}
+        with open("MaskPainter_config.json", 'w') as outfile:
+            json.dump(config, outfile)
+
+        model = Model(HeadlessMaster())
+        project_path = os.path.join(root_dir, "bench.json")
+        model.project.create_project(project_path)
+        for z in range(1, num_layers):
+            # layer uids are millisecond timestamps, so wait for the next one
+            time.sleep(0.002)
+            model.project.insert_layer(z)
+
+        rng = random.Random(self.args.seed)
+        radius = max(4, min(w, h) // 20)
+        for z in range(num_layers):
+            layer = model.project.get_layer_by_z(z)
+            layer.color = self.colors[z % len(self.colors)]
+            target = density * w * h
+            while cv.countNonZero(layer.cvMask) < target:
+                cv.circle(layer.cvMask, (rng.randrange(w), rng.randrange(h)), radius, 255, -1)
+        model.project.save()
+        model.load_project(project_path)
+        model.canvas.load(model.project.imgSize, (self.args.canvas_w, self.args.canvas_h))
+        return model
+
+    def _bench_render(self, case, model):
+        # full viewport frames, cold means an empty tile cache, and the whole mask composited without tiles
+        renderer = TileRenderer()
+        window = self._viewport_window(model)
+        cold = []
+        warm = []
+        tracemalloc.start()
+        for _ in range(self.args.repeat):
+            renderer.reset()
+            cold.append(self._time(lambda: self._render_frame(renderer, model, window)))
+            warm.append(self._time(lambda: self._render_frame(renderer, model, window)))
+        peak = self._stop_tracing()
+        self._add(case, "render_cold", cold, peak)
+        self._add(case, "render_warm", warm, peak)
+
+        project = model.project
+        layers = [project.get_layer_by_z(z) for z in range(project.numMasks)]
+        colors = Compositor.get_colors([layer.color for layer in layers])
+        background = np.array(Compositor.get_rgb(project.default_background_color), dtype=np.uint8)
+        masks = [layer.cvMask for layer in layers]
+        self._measure(case, "composite_full_mask", self.args.repeat,
+                      lambda: Compositor.composite(background, masks, colors, project.maskOpaque,
+                                                   project.imgSize))
+
+    def _bench_strokes(self, case, model):
+        # one sample per motion event: draw the segment, update the tiles, render the dirty region
+        renderer = TileRenderer()
+        self._render_frame(renderer, model, self._viewport_window(model))
+        layer = model.project.activeLayer
+        r = 10
+        rng = random.Random(self.args.seed)
+        w, h = model.project.imgSize
+        x, y = w // 2, h // 2
+
+        def segment(bx, by, nx, ny):
+            cv.line(layer.cvMask, (bx, by), (nx, ny), 255, r * 2)
+            cv.circle(layer.cvMask, (nx, ny), r, 255, -1)
+            layer.bump_mask_version()
+            window = (min(bx, nx) - r - 1, min(by, ny) - r - 1, max(bx, nx) + r + 2, max(by, ny) + r + 2)
+            renderer.mask_edited(layer, window)
+            left, top, right, bottom = window
+            window = (max(0, left), max(0, top), min(w, right), min(h, bottom))
+            ZoomEngine.zoom_image(renderer.render_region(model.project, window), model.canvas.level_zoom)
+
+        samples = []
+        tracemalloc.start()
+        for _ in range(self.args.stroke_segments):
+            nx = min(w - 1, max(0, x + rng.randint(-15, 15)))
+            ny = min(h - 1, max(0, y + rng.randint(-15, 15)))
+            samples.append(self._time(lambda: segment(x, y, nx, ny)))
+            x, y = nx, ny
+        self._add(case, "stroke_segment", samples, self._stop_tracing())
+
+    def _bench_zoom_pan(self, case, model):
+        # a frame per zoom step and per pan step, sharing one tile cache like the editor does
+        renderer = TileRenderer()
+        samples = []
+        tracemalloc.start()
+        canvas = model.canvas
+        for zoom in [1, 2, 4, 8, 4, 2, 1, 0.5, 0.25, 0.125, 0.25, 0.5, 1]:
+            canvas.set_zoom(zoom)
+            samples.append(self._time(lambda: self._render_frame(renderer, model, self._viewport_window(model))))
+        rng = random.Random(self.args.seed)
+        for _ in range(self.args.pan_steps):
+            canvas.move_camera_position(rng.randint(-40, 40), rng.randint(-40, 40))
+            samples.append(self._time(lambda: self._render_frame(renderer, model, self._viewport_window(model))))
+        canvas.set_zoom(1)
+        self._add(case, "zoom_pan_frame", samples, self._stop_tracing())
+
+    def _bench_undo(self, case, model):
+        # an undo entry per brush stroke and per layer operation, then undo all of them
+        stroke_samples = []
+        save_samples = []
+        undo_samples = []
+        tracemalloc.start()
+        for i in range(self.args.undo_steps):
+            stroke_samples.append(self._time(lambda: self._undoable_stroke(model, i)))
+            save_samples.append(self._time(model.save_undo_state))
+        for _ in range(2 * self.args.undo_steps):
+            undo_samples.append(self._time(model.undo))
+        peak = self._stop_tracing()
+        self._add(case, "undo_record_stroke", stroke_samples, peak)
+        self._add(case, "save_undo_state", save_samples, peak)
+        self._add(case, "undo", undo_samples, peak)
+
+    def _bench_export(self, case, model, root_dir):
+        path = os.path.join(root_dir, "bench_comp.png")
+        self._measure(case, "export", 1, lambda: ExportRenderer(model.project).write(path))
+
+    def _bench_save(self, case, model):
+        # save writes only the masks changed since the last save, save_full changes every mask first
+        # both wait for the background writer, save_blocking is only the part of save that blocks the ui
+        layers = list(model.project.layers.values())
+
+        def save_one():
+            model.project.activeLayer.bump_mask_version()
+            model.save()
+            model.wait_for_save()
+
+        def save_full():
+            for layer in layers:
+                layer.bump_mask_version()
+            model.save()
+            model.wait_for_save()
+
+        self._measure(case, "save", self.args.io_repeat, save_one)
+        self._measure(case, "save_full", self.args.io_repeat, save_full)
+
+        tracemalloc.start()
+        samples = []
+        for _ in range(self.args.io_repeat):
+            model.project.activeLayer.bump_mask_version()
+            samples.append(self._time(model.save))
+            model.wait_for_save()
+        self._add(case, "save_blocking", samples, self._stop_tracing())
+
+    def _bench_load(self, case, model):
+        path = model.project.projectPath
+        self._measure(case, "load_project", self.args.io_repeat, lambda: model.load_project(path))
+
+        # time to the first frame when only the active layer is visible, the hidden layers are read on use
+        for z in range(model.project.numMasks):
+            model.project.get_layer_by_z(z).isVisible = z == model.project.activeMask
+        model.project.save()
+        renderer = TileRenderer()
+
+        def load_first_frame():
+            model.load_project(path)
+            renderer.reset()
+            self._render_frame(renderer, model, self._viewport_window(model))
+
+        self._measure(case, "load_first_frame", self.args.io_repeat, load_first_frame)
+
+    ###########################################################################
+    #
+    #  helpers
+    #
+    ###########################################################################
+
+    @staticmethod
+    def _undoable_stroke(model, i):
+        # the model side of one short stroke, like CanvasPainter does it
+        w, h = model.project.imgSize
+        mask = model.project.activeLayer.cvMask
+        points = [((i * 37 + k * 9) % w, (i * 53 + k * 5) % h) for k in range(10)]
+        model.begin_mask_edit()
+        for (bx, by), (x, y) in zip(points, points[1:]):
+            model.record_mask_edit((min(bx, x) - 21, min(by, y) - 21, max(bx, x) + 22, max(by, y) + 22))
+            cv.line(mask, (bx, by), (x, y), 255, 40)
+        model.end_mask_edit()
+
+    @staticmethod
+    def _viewport_window(model):
+        canvas = model.canvas
+        return canvas.ms_zoom_left, canvas.ms_zoom_top, canvas.ms_zoom_right, canvas.ms_zoom_bottom
+
+    @staticmethod
+    def _render_frame(renderer, model, window):
+        composite = renderer.render(model.project, window, level=model.canvas.level)
+        return ZoomEngine.zoom_image(composite, model.canvas.level_zoom)
+
+    @staticmethod
+    def _time(fn):
+        start = time.perf_counter()
+        fn()
+        return (time.perf_counter() - start) * 1000
+
+    @staticmethod
+    def _stop_tracing():
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return peak / (1024 * 1024)
+
+    def _measure(self, case, scenario, repeat, fn):
+        tracemalloc.start()
+        samples = [self._time(fn) for _ in range(repeat)]
+        self._add(case, scenario, samples, self._stop_tracing())
+
+    def _add(self, case, scenario, samples, peak_mb=None):
+        samples = np.array(samples)
+        stats = {"n": len(samples),
+                 "mean_ms": float(samples.mean()),
+                 "p50_ms": float(np.percentile(samples, 50)),
+                 "p90_ms": float(np.percentile(samples, 90)),
+                 "p99_ms": float(np.percentile(samples, 99)),
+                 "max_ms": float(samples.max())}
+        self.results.append({"case": case, "scenario": scenario, "stats": stats, "peak_mem_mb": peak_mb})
+        print("  {:<20} p50 {:9.2f} ms  p99 {:9.2f} ms".format(scenario, stats["p50_ms"], stats["p99_ms"]))
+
+
+def compare(results, baseline_results, tolerance, min_delta_ms):
+    # prints the p50 ratio of every scenario that is in both runs, returns the number of regressions
+    baseline = {(r["case"], r["scenario"]): r for r in baseline_results}
+    regressions = 0
+    for result in results:
+        old = baseline.get((result["case"], result["scenario"]))
+        if not old or old["stats"]["p50_ms"] <= 0:
+            continue
+        ratio = result["stats"]["p50_ms"] / old["stats"]["p50_ms"]
+        delta = result["stats"]["p50_ms"] - old["stats"]["p50_ms"]
+        flag = ""
+        if abs(delta) < min_delta_ms:
+            # timer noise on very fast scenarios
+            pass
+        elif ratio > 1 + tolerance:
+            flag = "  REGRESSION"
+            regressions += 1
+        elif ratio < 1 - tolerance:
+            flag = "  faster"
+        print("{:<28} {:<20} {:9.2f} -> {:9.2f} ms  x{:.2f}{}".format(
+            result["case"], result["scenario"], old["stats"]["p50_ms"], result["stats"]["p50_ms"], ratio, flag))
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Headless MaskPainter benchmarks")
+    parser.add_argument("--preset", choices=sorted(Benchmark.presets), default="default")
+    parser.add_argument("--sizes", nargs="+", help="mask sizes like 1920x1080, overrides the preset")
+    parser.add_argument("--layers", nargs="+", type=int, help="layer counts, overrides the preset")
+    parser.add_argument("--densities", nargs="+", type=float, help="mask fill fractions, overrides the preset")
+    parser.add_argument("--canvas-w", type=int, default=1280)
+    parser.add_argument("--canvas-h", type=int, default=720)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--io-repeat", type=int, default=3)
+    parser.add_argument("--stroke-segments", type=int, default=200)
+    parser.add_argument("--pan-steps", type=int, default=50)
+    parser.add_argument("--undo-steps", type=int, default=10)
+    parser.add_argument("--max-mask-bytes", type=int, default=1 << 30,
+                        help="skip cases whose masks take more memory than this")
+    parser.add_argument("--disk-mask-pixels", type=int, default=DiskMask.minPixels,
+                        help="masks with at least this many pixels are stored on disk, 0 stores every mask on disk")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("--baseline", help="compare with the results in this json file")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed p50 slowdown against the baseline")
+    parser.add_argument("--min-delta-ms", type=float, default=0.05,
+                        help="p50 changes smaller than this are never reported")
+    args = parser.parse_args(argv)
+
+    preset = Benchmark.presets[args.preset]
+    args.sizes = args.sizes or preset["sizes"]
+    args.layers = args.layers or preset["layers"]
+    args.densities = args.densities or preset["densities"]
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    DiskMask.minPixels = args.disk_mask_pixels
+    results = Benchmark(args).run()
+
+    output = {"meta": {"time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                       "platform": platform.platform(),
+                       "python": platform.python_version(),
+                       "numpy": np.__version__,
+                       "opencv": cv.__version__,
+                       "args": {k: v for k, v in vars(args).items() if k not in ("output", "baseline")}},
+              "results": results}
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(output, outfile, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as infile:
+            baseline = json.load(infile)
+        regressions = compare(results, baseline["results"], args.tolerance, args.min_delta_ms)
+        print("{} regression(s)".format(regressions))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,105 @@
+"""
+Timing spans around the stages of the render pipeline, for finding where frame time goes.
+
+- tracing is off by default, set the MASKPAINTER_TRACE environment variable or use the Debug menu to turn it on
+- a span records its name, thread, start and duration, spans can nest and can run on any thread
+- a frame span is also counted in the rolling frame stats shown in the status bar
+- dump writes the recorded spans as a Chrome trace event json file, open it in chrome://tracing or Perfetto
+"""
+
+from collections import deque
+import json
+import os
+import threading
+import time
+
+
+class _Span:
+    def __init__(self, name, is_frame):
+        self.name = name
+        self.isFrame = is_frame
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        end = time.perf_counter()
+        Tracer.add_event(self.name, self.start, end, self.isFrame)
+        return False
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        return False
+
+
+class Tracer:
+    isEnabled = bool(os.environ.get("MASKPAINTER_TRACE"))
+
+    # deque appends are atomic, so worker threads can record without a lock
+    _events = deque(maxlen=200000)
+    _frames = deque(maxlen=600)
+    _origin = time.perf_counter()
+    _null_span = _NullSpan()
+
+    # seconds of frames that the rolling stats cover
+    stats_window = 2.0
+
+    @staticmethod
+    def set_enabled(is_enabled):
+        Tracer.isEnabled = is_enabled
+
+    @staticmethod
+    def span(name):
+        # with Tracer.span("stage"): ...
+        if not Tracer.isEnabled:
+            return Tracer._null_span
+        return _Span(name, False)
+
+    @staticmethod
+    def frame(name="frame"):
+        # a span that is also counted as one displayed frame
+        if not Tracer.isEnabled:
+            return Tracer._null_span
+        return _Span(name, True)
+
+    @staticmethod
+    def add_event(name, start, end, is_frame=False):
+        Tracer._events.append((name, threading.get_ident(), start, end))
+        if is_frame:
+            Tracer._frames.append((end, end - start))
+
+    @staticmethod
+    def clear():
+        Tracer._events.clear()
+        Tracer._frames.clear()
+
+    @staticmethod
+    def get_frame_stats():
+        # (fps, p50 ms, p99 ms) of the frames that ended in the last stats_window seconds, or None
+        now = time.perf_counter()
+        frames = [frame for frame in list(Tracer._frames) if now - frame[0] <= Tracer.stats_window]
+        if not frames:
+            return None
+        durations = sorted(duration for _, duration in frames)
+        p50 = durations[(len(durations) - 1) // 2]
+        p99 = durations[min(len(durations) - 1, int(round(0.99 * (len(durations) - 1))))]
+        return len(frames) / Tracer.stats_window, p50 * 1000, p99 * 1000
+
+    @staticmethod
+    def dump(file_path=None):
+        # write the spans as complete ("X") trace events with microsecond times, returns the file path
+        if file_path is None:
+            file_path = "MaskPainter_trace_{}.json".format(time.strftime("%Y%m%d_%H%M%S"))
+        pid = os.getpid()
+        events = [{"name": name, "ph": "X", "pid": pid, "tid": tid,
+                   "ts": (start - Tracer._origin) * 1e6, "dur": (end - start) * 1e6}
+                  for name, tid, start, end in list(Tracer._events)]
+        with open(file_path, 'w') as outfile:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, outfile)
+        return file_path
@@ -1,5 +1,4 @@
 from tkinter import messagebox
-import math
 
 
 class CanvasControl:
@@ -79,7 +78,7 @@ class CanvasControl:
             self.painter.zoom(e)
         elif e.delta < 0 and self.model.canvas.zoom > self.model.canvas.min_zoom:
             # zoom out
-            self.model.mouse_zoom(int(math.ceil(self.model.canvas.zoom / 2)), e)
+            self.model.mouse_zoom(self.model.canvas.zoom / 2, e)
             self.painter.zoom(e)
 
     def _start_b1(self, e):
@@ -129,12 +128,13 @@ class CanvasControl:
         self.painter.end_pan(e)
 
     def _mouse_move(self, e):
-        self.painter.render_canvas_image()
         if not self._isPan and not self.model.keyboard.is_pressed(self.panKey):
             self.painter.render_brush_outline(e.x, e.y)
+        else:
+            self.painter.hide_brush_outline()
 
     def _mouse_exit(self, _):
-        self.painter.render_canvas_image()
+        self.painter.hide_brush_outline()
 
     def _resize(self, e):
         if self.model.isProjectLoaded:
@@ -1,6 +1,8 @@
+import os
 from tkinter import *
-from tkinter import Menu
+from tkinter import Menu, messagebox
 
+from src.Tracer import Tracer
 from src.Utils import Utils
 
 
@@ -32,9 +34,9 @@ class MenuBar:
         top_menu.add_cascade(label="Edit", menu=edit_menu)
         self._init_edit_menu(edit_menu)
 
-        # debug_menu = Menu(top_menu)
-        # top_menu.add_cascade(label="Debug", menu=debug_menu)
-        # self._init_debug_menu(debug_menu)
+        debug_menu = Menu(top_menu)
+        top_menu.add_cascade(label="Debug", menu=debug_menu)
+        self._init_debug_menu(debug_menu)
 
     def _init_file_menu(self, menu, painter):
         menu.add_command(label="New", command=self._kb_create_project, accelerator="Ctrl+N")
@@ -86,6 +88,18 @@ class MenuBar:
     def _init_debug_menu(self, menu):
         menu.add_command(label="Break App", command=self.app.breakpoint_app)
         menu.add_command(label="CanvasModel", command=self.model.canvas.debug_out)
+        menu.add_separator()
+        self._trace_var = BooleanVar(value=Tracer.isEnabled)
+        menu.add_checkbutton(label="Trace Rendering", variable=self._trace_var, command=self._toggle_trace)
+        menu.add_command(label="Dump Trace", command=self._dump_trace)
+
+    def _toggle_trace(self):
+        Tracer.set_enabled(self._trace_var.get())
+
+    @staticmethod
+    def _dump_trace():
+        # the packaged app has no console, so the file path is shown in a dialog
+        messagebox.showinfo("Dump Trace", "Trace written to {}".format(os.path.abspath(Tracer.dump())))
 
     @staticmethod
     def _add_toggle(toggle_list, menu, index, key=None, on_key_press=None):
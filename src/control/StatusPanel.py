@@ -1,15 +1,28 @@
+from src.Tracer import Tracer
+
+
 class StatusPanel:
     def __init__(self, status, model):
         self.status = status
         self.model = model
+        self._trace_interval_ms = 500
         self.model.subject.layer.attach(self._update_layer)
         self.model.subject.project.attach(self._update_project)
         self.model.subject.save.attach(self._update_save)
         self.model.subject.export.attach(self._update_export)
         self.model.subject.zoom.attach(self._update_zoom)
+        self.status.after(self._trace_interval_ms, self._update_trace)
+
+    def _update_trace(self):
+        # while tracing, show the rolling frame stats whenever frames were drawn recently
+        if Tracer.isEnabled:
+            stats = Tracer.get_frame_stats()
+            if stats:
+                self.status.config(text="Trace: fps={:.1f} p50={:.1f}ms p99={:.1f}ms".format(*stats))
+        self.status.after(self._trace_interval_ms, self._update_trace)
 
     def _update_zoom(self):
-        self.status.config(text="Update: ZOOM: zoom={}%".format(self.model.canvas.zoom * 100))
+        self.status.config(text="Update: ZOOM: zoom={:g}%".format(self.model.canvas.zoom * 100))
 
     def _update_layer(self):
         active_mask = self.model.project.activeMask
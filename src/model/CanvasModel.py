@@ -8,6 +8,11 @@ There are 3 different spaces: mask space, world space, and canvas space.
 - zoom size is the smallest rectangle that is the canvas size or larger, where both axes are a multiple of zoom factor
     world space zoom is exactly zoom factor times larger than mask space zoom
 
+- zoom factors below 1 are served from a pyramid of the masks, where level k is scaled down by 2 ** k
+    level is the smallest k where zoom * 2 ** k is a whole number, and level zoom is that number
+    world space is the level image scaled up by level zoom, and the ms_zoom vars are in level space
+    at zoom 1 or more the level is 0 and level space is mask space
+
 - on load:
     mask img size is set and it never changes until unload
     zoom factor is initialized to 1
@@ -41,17 +46,21 @@ class CanvasModel:
     def __init__(self, is_reset=False):
         if not is_reset:
             # constants
-            self.min_zoom = 1
+            self.min_zoom = 0.125
             self.max_zoom = 8
 
         # zoom vars
         self.zoom = 1
+        self.level = 0
+        self.level_zoom = 1
 
         # mask img vars
         self.mask_w = 0
         self.mask_h = 0
 
         # derived from zoom and mask img size
+        self.level_w = 0
+        self.level_h = 0
         self.world_w = 0
         self.world_h = 0
 
@@ -104,23 +113,20 @@ class CanvasModel:
 
         self.canvas_w, self.canvas_h = canvas_size
         self.mask_w, self.mask_h = img_size
-        self.world_w = self.mask_w * self.zoom
-        self.world_h = self.mask_h * self.zoom
+        self._set_zoom_vars(self.zoom)
         self.ws_camera_x = self.world_w // 2
         self.ws_camera_y = self.world_h // 2
 
         self._derive_space_vars()
 
     def set_zoom(self, zoom):
-        old_zoom = self.zoom
-        self.zoom = Utils.clamp(zoom, self.min_zoom, self.max_zoom)
-        
+        old_world_w = self.world_w
+        old_world_h = self.world_h
+        self._set_zoom_vars(zoom)
+
         # manually derive world and camera, since old camera position should only be scaled during zoom
-        delta_zoom = 1.0 * self.zoom / old_zoom
-        self.world_w = self.mask_w * self.zoom
-        self.world_h = self.mask_h * self.zoom
-        self.ws_camera_x = int(math.floor(self.ws_camera_x * delta_zoom))
-        self.ws_camera_y = int(math.floor(self.ws_camera_y * delta_zoom))
+        self.ws_camera_x = int(math.floor(self.ws_camera_x * self.world_w / old_world_w))
+        self.ws_camera_y = int(math.floor(self.ws_camera_y * self.world_h / old_world_h))
 
         self._clamp_camera()
         self._derive_space_vars()
@@ -135,15 +141,13 @@ class CanvasModel:
         self.ws_camera_y += dy
 
         # zoom with no clamping and no deriving space vars
-        old_zoom = self.zoom
-        self.zoom = Utils.clamp(zoom, self.min_zoom, self.max_zoom)
+        old_world_w = self.world_w
+        old_world_h = self.world_h
+        self._set_zoom_vars(zoom)
 
         # manually derive world and camera, since old camera position should only be scaled during zoom
-        delta_zoom = 1.0 * self.zoom / old_zoom
-        self.world_w = self.mask_w * self.zoom
-        self.world_h = self.mask_h * self.zoom
-        self.ws_camera_x = int(math.floor(self.ws_camera_x * delta_zoom))
-        self.ws_camera_y = int(math.floor(self.ws_camera_y * delta_zoom))
+        self.ws_camera_x = int(math.floor(self.ws_camera_x * self.world_w / old_world_w))
+        self.ws_camera_y = int(math.floor(self.ws_camera_y * self.world_h / old_world_h))
 
         # move the world so the new camera moves to the mouse
         # clamp and derive space vars
@@ -173,7 +177,13 @@ class CanvasModel:
 
     def mouse_canvas_to_mask(self, e):
         x, y = self.mouse_canvas_to_world(e)
-        return x // self.zoom, y // self.zoom
+        return (x // self.level_zoom) << self.level, (y // self.level_zoom) << self.level
+
+    def mask_to_level_window(self, window):
+        # the smallest level space window that covers a mask space window
+        left, top, right, bottom = window
+        scale = 1 << self.level
+        return left >> self.level, top >> self.level, -(-right // scale), -(-bottom // scale)
 
     ###########################################################################
     #
@@ -181,6 +191,22 @@ class CanvasModel:
     #
     ###########################################################################
 
+    def _set_zoom_vars(self, zoom):
+        zoom = Utils.clamp(zoom, self.min_zoom, self.max_zoom)
+        self.zoom = int(zoom) if zoom >= 1 else zoom
+
+        # zoom out by rendering a smaller pyramid level, zoom in by scaling up level 0
+        self.level = 0
+        while self.zoom * (1 << self.level) < 1:
+            self.level += 1
+        self.level_zoom = int(self.zoom * (1 << self.level))
+
+        scale = 1 << self.level
+        self.level_w = -(-self.mask_w // scale)
+        self.level_h = -(-self.mask_h // scale)
+        self.world_w = self.level_w * self.level_zoom
+        self.world_h = self.level_h * self.level_zoom
+
     def _clamp_camera(self):
         left = self.ws_crop_w // 2
         right = self.world_w - int(math.ceil(self.ws_crop_w / 2.0))
@@ -204,14 +230,14 @@ class CanvasModel:
         self.ws_canvas_y = self.ws_camera_y - self.canvas_h // 2
 
         # zoom vars in world space and mask space
-        self.ms_zoom_left = max(0, int(math.floor(self.ws_canvas_x / self.zoom)))
-        self.ms_zoom_top = max(0, int(math.floor(self.ws_canvas_y / self.zoom)))
-        self.ws_zoom_left = self.ms_zoom_left * self.zoom
-        self.ws_zoom_top = self.ms_zoom_top * self.zoom
-        self.ms_zoom_right = int(math.ceil((self.ws_zoom_left + self.ws_crop_w) / self.zoom))
-        self.ms_zoom_bottom = int(math.ceil((self.ws_zoom_top + self.ws_crop_h) / self.zoom))
-        self.ws_zoom_right = self.ms_zoom_right * self.zoom
-        self.ws_zoom_bottom = self.ms_zoom_bottom * self.zoom
+        self.ms_zoom_left = max(0, int(math.floor(self.ws_canvas_x / self.level_zoom)))
+        self.ms_zoom_top = max(0, int(math.floor(self.ws_canvas_y / self.level_zoom)))
+        self.ws_zoom_left = self.ms_zoom_left * self.level_zoom
+        self.ws_zoom_top = self.ms_zoom_top * self.level_zoom
+        self.ms_zoom_right = int(math.ceil((self.ws_zoom_left + self.ws_crop_w) / self.level_zoom))
+        self.ms_zoom_bottom = int(math.ceil((self.ws_zoom_top + self.ws_crop_h) / self.level_zoom))
+        self.ws_zoom_right = self.ms_zoom_right * self.level_zoom
+        self.ws_zoom_bottom = self.ms_zoom_bottom * self.level_zoom
 
         # canvas space vars
         self.cs_crop_x = self.ws_crop_x - self.ws_canvas_x
@@ -224,6 +250,10 @@ class CanvasModel:
         print("{}\t{}".format("self.zoom".ljust(w), self.zoom))
         print("{}\t{}".format("self.mask_w".ljust(w), self.mask_w))
         print("{}\t{}".format("self.mask_h".ljust(w), self.mask_h))
+        print("{}\t{}".format("self.level".ljust(w), self.level))
+        print("{}\t{}".format("self.level_zoom".ljust(w), self.level_zoom))
+        print("{}\t{}".format("self.level_w".ljust(w), self.level_w))
+        print("{}\t{}".format("self.level_h".ljust(w), self.level_h))
         print("{}\t{}".format("self.world_w".ljust(w), self.world_w))
         print("{}\t{}".format("self.world_h".ljust(w), self.world_h))
         print("{}\t{}".format("self.canvas_w".ljust(w), self.canvas_w))
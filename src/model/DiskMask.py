@@ -0,0 +1,77 @@
+"""
+Out of core storage for masks too large to keep every layer in memory, like 16k x 16k maps with many layers.
+
+- a large mask lives in an anonymous scratch file mapped with numpy memmap, so it is still an ndarray,
+    and the painter, undo, the tile renderer and the journal work on it through the same slices as before
+- the os page cache keeps the recently used chunks of the file in memory, writes dirty chunks back to disk
+    and drops clean ones under memory pressure, so only the working set of the masks is resident
+- whole mask copies, for the save and export snapshots, are made in strips of rows into another scratch file
+- the pyramid levels of a mask on disk are on disk too, and are built in strips
+- the scratch file is deleted by the os once its mask is garbage collected
+"""
+
+import tempfile
+import numpy as np
+
+
+class DiskMask:
+    # masks with at least this many pixels are stored on disk, None keeps every mask in memory
+    minPixels = 64 * 1024 * 1024
+
+    # directory of the scratch files, None is the system temp dir
+    scratchDir = None
+
+    # rows copied at a time, so a copy never holds a whole large mask in memory
+    stripRows = 1024
+
+    @staticmethod
+    def is_large(shape):
+        return DiskMask.minPixels is not None and shape[0] * shape[1] >= DiskMask.minPixels
+
+    @staticmethod
+    def zeros(shape):
+        # an empty (h, w) mask, a new scratch file reads as zeros
+        if not DiskMask.is_large(shape):
+            return np.zeros(shape, dtype=np.uint8)
+        return DiskMask._create(shape)
+
+    @staticmethod
+    def zeros_like(mask, shape):
+        # an empty (h, w) mask, on disk if mask is on disk, like a pyramid level of it
+        if not isinstance(mask, np.memmap):
+            return np.zeros(shape, dtype=np.uint8)
+        return DiskMask._create(shape)
+
+    @staticmethod
+    def from_array(array):
+        # a decoded mask, moved to disk if it is large
+        if not DiskMask.is_large(array.shape):
+            return array
+        return DiskMask._copy_to_disk(array)
+
+    @staticmethod
+    def copy(mask):
+        # a snapshot of a whole mask, on disk if the mask is on disk
+        if not isinstance(mask, np.memmap):
+            return mask.copy()
+        return DiskMask._copy_to_disk(mask)
+
+    ###########################################################################
+    #
+    #  helpers
+    #
+    ###########################################################################
+
+    @staticmethod
+    def _create(shape):
+        # the mapping keeps the unlinked file alive after it is closed here
+        with tempfile.TemporaryFile(prefix="MaskPainter_", dir=DiskMask.scratchDir) as file:
+            file.truncate(shape[0] * shape[1])
+            return np.memmap(file, dtype=np.uint8, mode='r+', shape=shape)
+
+    @staticmethod
+    def _copy_to_disk(array):
+        mask = DiskMask._create(array.shape)
+        for top in range(0, array.shape[0], DiskMask.stripRows):
+            mask[top:top + DiskMask.stripRows] = array[top:top + DiskMask.stripRows]
+        return mask
@@ -0,0 +1,253 @@
+"""
+Append-only journal of the edits made since the last save, for crash recovery and session resume.
+
+- a record is written for every finished brush stroke, and for every layer or project change
+- stroke records hold the after-pixels of the mask tiles the stroke touched, MaskCodec encoded
+- project records hold the layer order, the layer fields and the project fields, like the project json,
+    a layer that appears with painted pixels, like one restored by undo, also gets a record of its whole mask
+- every record is absolute, so replaying a record twice or over a newer mask file gives the same result
+- the editor only copies the tiles and queues the record, encoding, writing and fsync happen on a writer thread,
+    fsync is batched to at most one per sync interval
+- save moves the journal aside before it writes the project and deletes it once the project is written,
+    so a crash during the save still finds every edit in the moved journal
+- a journal with records when a project is opened means the editor did not save before it stopped,
+    load replays it over the saved project
+"""
+
+import atexit
+import json
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+import cv2 as cv
+
+from src.Tracer import Tracer
+from src.model.MaskCodec import MaskCodec
+
+
+class EditJournal:
+    # kind, body length, crc32 of the body
+    _header = struct.Struct('>cII')
+    _project_kind = b'P'
+    _tiles_kind = b'T'
+
+    def __init__(self, path, sync_interval=0.5):
+        self.path = path
+        self.rotatedPath = path + '.1'
+        self.sync_interval = sync_interval
+        self.error = None
+
+        self._queue = queue.Queue()
+        self._thread = None
+        self._uids = set()
+
+    @staticmethod
+    def remove(path):
+        # delete a journal left by an older project at the same path
+        for file_path in (path, path + '.1'):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    def replay(self, project):
+        # apply the records of a journal left by an unclean shutdown to the loaded project
+        # returns True if any record was replayed
+        data = b''
+        size = 0
+        with Tracer.span("journal_replay"):
+            for file_path in (self.rotatedPath, self.path):
+                if os.path.exists(file_path):
+                    with open(file_path, 'rb') as file:
+                        file_data = file.read()
+                    size += len(file_data)
+                    data += EditJournal._read_records(file_data, project)
+
+            # keep only the records that could be read, so new records are not appended after a torn one
+            if len(data) < size or os.path.exists(self.rotatedPath):
+                temp_path = self.path + '.tmp'
+                with open(temp_path, 'wb') as file:
+                    file.write(data)
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(temp_path, self.path)
+                if os.path.exists(self.rotatedPath):
+                    os.remove(self.rotatedPath)
+        return len(data) > 0
+
+    def start(self, project):
+        self._uids = set(project.layerKeys)
+        self._thread = threading.Thread(target=self._run, name='EditJournal', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def append_project(self, project):
+        if not self._is_writing():
+            return
+        for uid in project.layerKeys:
+            if uid not in self._uids:
+                mask = project.get_layer_by_uid(uid).cvMask
+                if cv.countNonZero(mask) > 0:
+                    self.append_tiles(uid, mask, max(mask.shape), [(0, 0)])
+        self._uids = set(project.layerKeys)
+        # serialized here, the layer lists keep changing on the editor thread
+        self._queue.put((self._project_kind, json.dumps(project.get_project_dict())))
+
+    def append_tiles(self, uid, mask, tile_size, keys):
+        # copy the current pixels of the (row, col) tiles of the mask, they are encoded on the writer thread
+        if not self._is_writing():
+            return
+        t = tile_size
+        tiles = [(row, col, mask[row * t:(row + 1) * t, col * t:(col + 1) * t].copy()) for row, col in keys]
+        self._queue.put((self._tiles_kind, (uid, t, tiles)))
+
+    def rotate(self):
+        # call before the project is saved, records queued after this go to a new journal
+        if self._is_writing():
+            self._queue.put(('rotate', None))
+
+    def remove_rotated(self):
+        # call once the project is saved, the moved journal is now part of the saved project
+        if self._is_writing():
+            self._queue.put(('remove_rotated', None))
+
+    def close(self, discard=False):
+        # discard deletes the journal, when the unsaved edits are given up
+        atexit.unregister(self.close)
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(('close', discard))
+            self._thread.join()
+        elif discard:
+            EditJournal.remove(self.path)
+        self._thread = None
+
+    ###########################################################################
+    #
+    #  helpers
+    #
+    ###########################################################################
+
+    def _is_writing(self):
+        return self._thread is not None and self.error is None
+
+    def _run(self):
+        file = None
+        last_sync = time.perf_counter()
+        is_synced = True
+        try:
+            while True:
+                timeout = None if is_synced else max(0.0, last_sync + self.sync_interval - time.perf_counter())
+                try:
+                    kind, body = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    kind, body = 'sync', None
+
+                if kind in (self._project_kind, self._tiles_kind):
+                    if file is None:
+                        file = self._open()
+                    with Tracer.span("journal_write"):
+                        file.write(self._encode_record(kind, body))
+                    is_synced = False
+                    # write to the os as soon as the queue is drained, but fsync only once per interval
+                    if self._queue.empty():
+                        file.flush()
+                    if time.perf_counter() - last_sync < self.sync_interval:
+                        continue
+
+                if file is not None and not is_synced:
+                    with Tracer.span("journal_sync"):
+                        file.flush()
+                        os.fsync(file.fileno())
+                last_sync = time.perf_counter()
+                is_synced = True
+
+                if kind == 'rotate':
+                    file = self._close_file(file)
+                    self._rotate()
+                elif kind == 'remove_rotated':
+                    if os.path.exists(self.rotatedPath):
+                        os.remove(self.rotatedPath)
+                elif kind == 'close':
+                    file = self._close_file(file)
+                    if body:
+                        EditJournal.remove(self.path)
+                    return
+        except Exception as e:
+            self.error = e
+            self._close_file(file)
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.mkdir(directory)
+        return open(self.path, 'ab')
+
+    @staticmethod
+    def _close_file(file):
+        if file is not None:
+            file.close()
+        return None
+
+    def _rotate(self):
+        if not os.path.exists(self.path):
+            return
+        if os.path.exists(self.rotatedPath):
+            # an earlier save failed before it removed its moved journal, keep both
+            with open(self.path, 'rb') as src, open(self.rotatedPath, 'ab') as dst:
+                dst.write(src.read())
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.remove(self.path)
+        else:
+            os.replace(self.path, self.rotatedPath)
+
+    def _encode_record(self, kind, body):
+        if kind == self._project_kind:
+            data = body.encode('utf-8')
+        else:
+            uid, tile_size, tiles = body
+            index = []
+            payloads = []
+            for row, col, pixels in tiles:
+                is_packed, shape, payload = MaskCodec.encode(pixels)
+                index.append([row, col, is_packed, shape[0], shape[1], len(payload)])
+                payloads.append(payload)
+            header = json.dumps({"uid": uid, "tile_size": tile_size, "tiles": index}).encode('utf-8')
+            data = struct.pack('>I', len(header)) + header + b''.join(payloads)
+        return self._header.pack(kind, len(data), zlib.crc32(data) & 0xffffffff) + data
+
+    @staticmethod
+    def _read_records(data, project):
+        # apply every complete record, stop at the first torn or corrupt one
+        # returns the bytes of the records that were applied
+        offset = 0
+        size = EditJournal._header.size
+        while offset + size <= len(data):
+            kind, length, crc = EditJournal._header.unpack_from(data, offset)
+            body = data[offset + size:offset + size + length]
+            if len(body) < length or zlib.crc32(body) & 0xffffffff != crc:
+                break
+            if kind == EditJournal._project_kind:
+                project.set_project_dict(json.loads(body.decode('utf-8')))
+            elif kind == EditJournal._tiles_kind:
+                EditJournal._apply_tiles(body, project)
+            else:
+                break
+            offset += size + length
+        return data[:offset]
+
+    @staticmethod
+    def _apply_tiles(body, project):
+        header_size = struct.unpack_from('>I', body)[0]
+        header = json.loads(body[4:4 + header_size].decode('utf-8'))
+        layer = project.layers.get(header["uid"])
+        if layer is None:
+            return
+        t = header["tile_size"]
+        offset = 4 + header_size
+        for row, col, is_packed, h, w, length in header["tiles"]:
+            pixels = MaskCodec.decode((is_packed, (h, w), body[offset:offset + length]))
+            layer.cvMask[row * t:row * t + h, col * t:col * t + w] = pixels
+            offset += length
+        layer.bump_mask_version()
@@ -1,8 +1,53 @@
+import itertools
+import threading
+
+from src.Tracer import Tracer
+
+# mask versions come from one global counter, so a version number identifies one state of one mask
+_mask_versions = itertools.count()
+
+
 class Layer:
-    def __init__(self, json_layer, cv_mask):
+    # cv_mask can be None when a loader is given, the loader reads the saved mask the first time it is used
+    # a layer whose mask equals the saved one can be unloaded, and is read again when it is used again
+    def __init__(self, json_layer, cv_mask, loader=None):
         self.name = json_layer["name"]
         self.color = json_layer["color"]
         self.isVisible = json_layer["visible"]
         self.isLocked = json_layer["locked"]
 
-        self.cvMask = cv_mask
+        self._cvMask = cv_mask
+        self._loader = loader
+        self._load_lock = threading.Lock()
+        self.maskVersion = next(_mask_versions)
+
+    @property
+    def cvMask(self):
+        cv_mask = self._cvMask
+        if cv_mask is None:
+            cv_mask = self.load()
+        return cv_mask
+
+    @cvMask.setter
+    def cvMask(self, cv_mask):
+        self._cvMask = cv_mask
+
+    def is_loaded(self):
+        return self._cvMask is not None
+
+    def load(self):
+        # the tk thread and the background loader can both ask for the mask, only one of them reads it
+        with self._load_lock:
+            if self._cvMask is None:
+                with Tracer.span("load_layer"):
+                    self._cvMask = self._loader()
+            return self._cvMask
+
+    def unload(self):
+        if self._loader is not None:
+            with self._load_lock:
+                self._cvMask = None
+
+    # mask pixels changed, so save writes the mask and the tile renderer rebuilds its tiles
+    def bump_mask_version(self):
+        self.maskVersion = next(_mask_versions)
@@ -0,0 +1,35 @@
+import zlib
+import cv2 as cv
+import numpy as np
+
+
+class MaskCodec:
+    # lossless compression of uint8 mask pixels for the undo history
+    # painted masks are binary, 0 or 255, so they are packed to one bit per pixel before zlib
+    # anything else, like masks read from lossy files, is compressed as raw bytes
+    level = 1
+
+    @staticmethod
+    def encode(pixels):
+        # returns (is_packed, shape, payload)
+        pixels = np.ascontiguousarray(pixels)
+        if MaskCodec.is_binary(pixels):
+            return True, pixels.shape, zlib.compress(np.packbits(pixels, axis=None).tobytes(), MaskCodec.level)
+        return False, pixels.shape, zlib.compress(pixels.tobytes(), MaskCodec.level)
+
+    @staticmethod
+    def decode(encoded):
+        is_packed, shape, payload = encoded
+        data = np.frombuffer(zlib.decompress(payload), dtype=np.uint8)
+        if is_packed:
+            bits = np.unpackbits(data, count=int(np.prod(shape)))
+            return (bits * 255).reshape(shape)
+        return data.reshape(shape).copy()
+
+    @staticmethod
+    def nbytes(encoded):
+        return len(encoded[2])
+
+    @staticmethod
+    def is_binary(pixels):
+        return pixels.size == 0 or cv.countNonZero(cv.inRange(pixels, 1, 254).reshape(-1)) == 0
@@ -1,11 +1,14 @@
 from tkinter import filedialog, messagebox
-import copy
 
 from src.ObservableSubject import ObservableSubject
+from src.Tracer import Tracer
 from src.model.ProjectModel import ProjectModel
 from src.model.CanvasModel import CanvasModel
 from src.model.KeyboardModel import KeyboardModel
+from src.model.ProjectWriter import ProjectWriter
+from src.model.EditJournal import EditJournal
 from src.model.UndoHistory import UndoHistory
+from src.model.UndoEntry import MaskPatchEntry, FieldEntry, ProjectStateEntry
 
 
 class Subject:
@@ -20,19 +23,36 @@ class Subject:
 
 
 class Model:
+    # memory the undo history may hold before it drops its oldest entries
+    undoBudgetBytes = 256 * 1024 * 1024
+
+    # how often the tk thread checks if a background save finished
+    savePollIntervalMs = 50
+
     def __init__(self, master=None):
         if master:
+            self._master = master
             self.subject = Subject()
             self.project = ProjectModel()
             self.canvas = CanvasModel()
             self.keyboard = KeyboardModel(master)
-            self._history = UndoHistory(20)
+            self._history = UndoHistory(self.undoBudgetBytes)
 
         # save subject
         self.isCurrentSaved = True
+        self._writer = None
+        self._is_save_queued = False
+        self._field_edits = 0
+        self._saved_field_edits = 0
 
         # undo subject
         self._history.reset()
+        self._mask_edit = None
+
+        # journal of the edits since the last save, open while a project is loaded
+        # after save as, the journal of the old path is kept until the project is written to the new one
+        self._journal = None
+        self._retired_journal = None
 
         # project subject
         self.isProjectLoaded = False
@@ -44,6 +64,8 @@ class Model:
         self.brushSizeMax = 40
 
     def _reset(self):
+        self.wait_for_save()
+        self._close_journal()
         self.__init__()
 
     def has_undo(self):
@@ -59,32 +81,33 @@ class Model:
 
     # change layer data and notify observers
     def toggle_mask_opacity(self):
-        self.save_undo_state()
+        self.save_field_undo_state([(None, "maskOpaque")])
         self.project.toggle_mask_opacity()
         self._notify_needs_save()
 
     def set_active_layer(self, z):
-        self.save_undo_state()
+        # setting the active layer also shows it
+        self.save_field_undo_state([(None, "activeMask"), (self.project.layerKeys[z], "isVisible")])
         self.project.set_active_layer(z)
         self._notify_needs_save()
 
     def toggle_layer_visibility(self, z):
-        self.save_undo_state()
+        self.save_field_undo_state([(self.project.layerKeys[z], "isVisible")])
         self.project.toggle_layer_visibility(z)
         self._notify_needs_save()
 
     def toggle_layer_lock(self, z):
-        self.save_undo_state()
+        self.save_field_undo_state([(self.project.layerKeys[z], "isLocked")])
         self.project.toggle_layer_lock(z)
         self._notify_needs_save()
 
     def set_layer_name(self, z, name):
-        self.save_undo_state()
+        self.save_field_undo_state([(self.project.layerKeys[z], "name")])
         self.project.get_layer_by_z(z).name = name
         self._notify_needs_save()
 
     def set_layer_color(self, z, color):
-        self.save_undo_state()
+        self.save_field_undo_state([(self.project.layerKeys[z], "color")])
         self.project.get_layer_by_z(z).color = color
         self._notify_needs_save()
 
@@ -92,8 +115,7 @@ class Model:
         self.isCurrentSaved = False
         self.subject.save.notify()
 
-    def export_comp_image(self, pil_image):
-        self.project.export_comp_image(pil_image)
+    def set_comp_image_exported(self):
         self.subject.export.notify()
 
     def add_layer(self, layer):
@@ -116,12 +138,55 @@ class Model:
         self.canvas.set_mouse_zoom(zoom_factor, e)
         self.subject.zoom.notify()
 
+    def save_field_undo_state(self, targets):
+        # property changes only save the (layer uid, field) targets they change, a uid of None is a project field
+        self._history.save_state(FieldEntry(self.project, targets))
+        self.subject.undo.notify()
+
     def save_undo_state(self):
-        project = copy.deepcopy(self.project)
-        self._history.save_state(project)
+        # adding and removing layers saves the layer order and fields, the mask arrays are shared and never copied
+        with Tracer.span("save_undo_state"):
+            self._history.save_state(ProjectStateEntry(self.project))
         self.subject.undo.notify()
 
+    def begin_mask_edit(self):
+        # a brush stroke on the active layer starts, its undo entry collects before-pixels while it is painted
+        self.end_mask_edit()
+        self._mask_edit = MaskPatchEntry(self.project.layerKeys[self.project.activeMask])
+
+    def record_mask_edit(self, window):
+        # call before drawing into the mask space window of the active layer
+        # undo and redo end the stroke, the rest of a stroke still painted after them gets a new entry
+        if self._mask_edit is None:
+            self.begin_mask_edit()
+        with Tracer.span("record_mask_edit"):
+            self._mask_edit.record(self.project.activeLayer.cvMask, window)
+
+    def end_mask_edit(self):
+        if self._mask_edit is not None:
+            entry = self._mask_edit
+            self._mask_edit = None
+            if not entry.is_empty():
+                entry.compress()
+                self._history.save_state(entry)
+                self._journal_mask_patch(entry)
+                self.subject.undo.notify()
+
+    def _journal_mask_patch(self, entry):
+        # the journal records the pixels the patch tiles hold now, after the stroke or after undo and redo
+        layer = self.project.get_layer_by_uid(entry.layerUid)
+        self._journal.append_tiles(entry.layerUid, layer.cvMask, entry.tile_size, entry.tiles.keys())
+
+    def _close_journal(self):
+        # the unsaved edits are given up, so the journal is deleted
+        if self._journal is not None:
+            self._journal.close(discard=True)
+            self._journal = None
+
     def _notify_needs_save(self):
+        self._journal.append_project(self.project)
+        self.project.evict_hidden_layers()
+        self._field_edits += 1
         self.isCurrentSaved = False
         self.subject.project.notify()
         self.subject.layer.notify()
@@ -135,37 +200,96 @@ class Model:
     ################################
 
     def undo(self):
+        self.end_mask_edit()
         if self._history.has_undo():
-            self.project = self._history.undo(self.project)
+            entry = self._history.undo(self.project)
+            if isinstance(entry, MaskPatchEntry):
+                self._journal_mask_patch(entry)
             self._notify_needs_save()
 
     def redo(self):
+        self.end_mask_edit()
         if self._history.has_redo():
-            self.project = self._history.redo(self.project)
+            entry = self._history.redo(self.project)
+            if isinstance(entry, MaskPatchEntry):
+                self._journal_mask_patch(entry)
             self._notify_needs_save()
 
     def move_active(self, before, after):
         if before != after and after >= 0 and after < self.project.numMasks:
-            self.save_undo_state()
+            self.save_field_undo_state([(None, "layerKeys"), (None, "activeMask")])
             self.project.move_active(before, after)
             self._notify_needs_save()
 
     def save(self):
-        self.project.save()
-        self.isCurrentSaved = True
-        self.subject.save.notify()
+        # a save while another one is written starts when that one is done
+        if self._writer is not None:
+            self._is_save_queued = True
+            return
+        self._start_save()
+
+    def wait_for_save(self):
+        # block until a background save is written, before the project is closed or replaced
+        while self._writer is not None:
+            self._writer.join()
+            self._finish_save()
 
     def prompt_save_as(self):
-        project_file_path = filedialog.asksaveasfilename(title="Save as a new project json file",
+        project_file_path = filedialog.asksaveasfilename(title="Save as a new project file",
                                                          defaultextension=".json",
-                                                         filetypes=[("json files", "*.json")])
+                                                         filetypes=[("json files", "*.json"),
+                                                                    ("single file projects", "*.mpk")])
         if project_file_path:
-            self.project.save_as(project_file_path)
-            self._reset()
+            self.wait_for_save()
+            self._retired_journal = self._journal
+            self.project.set_project_path(project_file_path)
+            self._journal = EditJournal(self.project.get_journal_path())
+            self._journal.start(self.project)
+            self._start_save()
+            self.subject.project.notify()
+            self.subject.save.notify()
+
+    def _start_save(self):
+        # the masks and fields are copied here, encoding and writing happen on a worker thread
+        # the journal moves aside while the project is written, then the saved project holds its edits
+        self._journal.rotate()
+        self._writer = ProjectWriter(self.project)
+        self._saved_field_edits = self._field_edits
+        self._writer.start()
+        self._master.after(self.savePollIntervalMs, self._poll_save)
+
+    def _poll_save(self):
+        if self._writer is None:
+            return
+        if not self._writer.isDone:
+            self._master.after(self.savePollIntervalMs, self._poll_save)
+            return
+        self._finish_save()
+
+    def _finish_save(self):
+        writer = self._writer
+        self._writer = None
+        if writer.error is not None:
+            self._is_save_queued = False
+            raise writer.error
+
+        self.project.set_saved(writer)
+        self.project.evict_hidden_layers()
+        self._journal.remove_rotated()
+        if self._retired_journal is not None:
+            self._retired_journal.close(discard=True)
+            self._retired_journal = None
+
+        # edits made while the writer ran are not part of the saved project
+        self.isCurrentSaved = self._field_edits == self._saved_field_edits and not self.project.get_dirty_keys()
+        self.subject.save.notify()
 
-            self.load_project(project_file_path)
+        if self._is_save_queued:
+            self._is_save_queued = False
+            self._start_save()
 
     def unload_project(self):
+        self.wait_for_save()
         if not self.isCurrentSaved:
             is_ok = messagebox.askyesno("Close Project", "You will lose any unsaved data. Are you sure?")
             if not is_ok:
@@ -179,6 +303,7 @@ class Model:
         stop_here=1
 
     def prompt_load_project(self):
+        self.wait_for_save()
         if not self.isCurrentSaved:
             is_ok = messagebox.askyesno("Open Project", "You will lose any unsaved data. Are you sure?")
             if not is_ok:
@@ -189,37 +314,49 @@ class Model:
             self.load_project(json_path)
 
     def load_project(self, project_file_path):
+        self.wait_for_save()
+        self._close_journal()
         self.project.load_project(project_file_path)
+
+        # a journal with records is left by an editor that stopped without saving, replay it
+        self._journal = EditJournal(self.project.get_journal_path())
+        is_replayed = self._journal.replay(self.project)
+        self._journal.start(self.project)
         self.canvas.resize_canvas(self.project.imgSize)
 
         self.isProjectLoaded = True
-        self.isCurrentSaved = True
+        self.isCurrentSaved = not is_replayed
         self.subject.load.notify()
         self.subject.project.notify()
+        self.subject.save.notify()
         # self.subject.undo.notify()
 
     def prompt_create_project(self):
+        self.wait_for_save()
         if not self.isCurrentSaved:
             is_ok = messagebox.askyesno("Open Project", "You will lose any unsaved data. Are you sure?")
             if not is_ok:
                 return
 
-        project_file_path = filedialog.asksaveasfilename(title="Create a project json file",
+        project_file_path = filedialog.asksaveasfilename(title="Create a project file",
                                                          defaultextension=".json",
-                                                         filetypes=[("json files", "*.json")])
+                                                         filetypes=[("json files", "*.json"),
+                                                                    ("single file projects", "*.mpk")])
         if project_file_path:
             self.project.create_project(project_file_path)
             self.load_project(project_file_path)
 
     def prompt_create_background_project(self):
+        self.wait_for_save()
         if not self.isCurrentSaved:
             is_ok = messagebox.askyesno("Open Project", "You will lose any unsaved data. Are you sure?")
             if not is_ok:
                 return
 
-        project_file_path = filedialog.asksaveasfilename(title="Create a project json file",
+        project_file_path = filedialog.asksaveasfilename(title="Create a project file",
                                                          defaultextension=".json",
-                                                         filetypes=[("json files", "*.json")])
+                                                         filetypes=[("json files", "*.json"),
+                                                                    ("single file projects", "*.mpk")])
         if project_file_path:
             bg_image_file_path = filedialog.askopenfilename(title="Open background image file",
                                                             defaultextension=".jpg",
@@ -1,15 +1,41 @@
+import contextlib
+import functools
 import json
 from types import SimpleNamespace
 import os
+import struct
+import threading
 import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 import cv2 as cv
 import numpy as np
 
+from src.Tracer import Tracer
 from src.Utils import Utils
+from src.model.DiskMask import DiskMask
+from src.model.EditJournal import EditJournal
+from src.model.ProjectWriter import ProjectWriter
 from src.model.Layer import Layer
 
 
 class ProjectModel:
+    # masks are decoded and encoded on a bounded thread pool, the opencv png codec releases the gil
+    maskIoWorkers = min(8, os.cpu_count() or 1)
+
+    # visible layers are read on load, hidden layers are read when first used or by the background loader
+    # optionally, hidden layers that are saved and not active are dropped from memory, and read again when used
+    evictHiddenLayers = False
+
+    # a single file project is a zip of the project json, one png per mask and the decoded background
+    # the zip directory is the index, so each layer is read without reading the others
+    containerExtension = ".mpk"
+    containerProjectName = "project.json"
+    containerBackgroundName = "background.npy"
+
+    # decodes of large masks, one at a time
+    _large_mask_lock = threading.Lock()
+
     def __init__(self):
         self._config_file_path = "MaskPainter_config.json"
         self._comp_dir = "comp"
@@ -22,6 +48,7 @@ class ProjectModel:
         self.projectName = None          # ie. 'example_project'
         self.compRootDir = None          # ie. 'C:/some_path/app_root/projects/comp/'
         self.maskRootDir = None          # ie. 'C:/some_path/app_root/projects/mask/'
+        self.isContainer = False         # True for a single file project, ie. 'example_project.mpk'
 
         self.backgroundImagePath = None
         self.cvBackgroundImage = None
@@ -36,6 +63,9 @@ class ProjectModel:
         self.imgSize = None
         self.numMasks = None
 
+        # uid -> layer maskVersion of the mask file on disk, a layer whose version differs is written by save
+        self._savedMaskVersions = dict()
+
     def unload(self):
         self.__init__()
 
@@ -49,8 +79,17 @@ class ProjectModel:
 
     @staticmethod
     def _generate_mask_file_name(image_prefix, image_key):
+        return "{}_mask{}.png".format(image_prefix, image_key)
+
+    # masks of older projects, migrated to png when the project is loaded
+    @staticmethod
+    def _generate_jpg_mask_file_name(image_prefix, image_key):
         return "{}_mask{}.jpg".format(image_prefix, image_key)
 
+    @staticmethod
+    def _generate_journal_file_name(image_prefix):
+        return "{}_journal.bin".format(image_prefix)
+
     @staticmethod
     def _generate_background_file_name(image_prefix):
         return "{}_background.jpg".format(image_prefix)
@@ -84,6 +123,51 @@ class ProjectModel:
         f.close()
         return obj
 
+    @staticmethod
+    def get_container_mask_name(image_key):
+        return "mask/{}.png".format(image_key)
+
+    def get_mask_path(self, k):
+        return os.path.join(self.maskRootDir, self._generate_mask_file_name(self.projectName, k))
+
+    def get_mask_reader(self, k):
+        # reads the saved mask of the layer from where the project is saved now, also once it is saved elsewhere
+        return functools.partial(ProjectModel._read_mask_source, self._get_mask_source(k))
+
+    def get_background_path(self):
+        return os.path.join(self.maskRootDir, self._generate_background_file_name(self.projectName))
+
+    def get_dirty_keys(self):
+        # layers painted, inserted or restored since the last save, moving a layer only changes the json
+        return [k for k in self.layerKeys if self._savedMaskVersions.get(k) != self.layers[k].maskVersion]
+
+    def get_removed_keys(self):
+        # layers with a saved mask that are not in the project anymore
+        return [k for k in self._savedMaskVersions if k not in self.layers]
+
+    @staticmethod
+    def map_masks(function, *args):
+        # runs function on the mask io pool, returns the results in the order of the arguments
+        # the first exception is raised here
+        with ThreadPoolExecutor(max_workers=ProjectModel.maskIoWorkers, thread_name_prefix="MaskIO") as pool:
+            return list(pool.map(function, *args))
+
+    def load_layers_in_background(self):
+        # read the layers that are not read yet, so showing a hidden layer later does not wait for it
+        layers = [self.layers[k] for k in self.layerKeys if not self.layers[k].is_loaded()]
+        if layers and not self.evictHiddenLayers:
+            threading.Thread(target=self._load_layers, args=(layers,), name='LayerLoader', daemon=True).start()
+
+    def evict_hidden_layers(self):
+        # drop the masks of hidden, inactive layers that equal their saved mask
+        if not self.evictHiddenLayers:
+            return
+        for k in self.layerKeys:
+            layer = self.layers[k]
+            is_saved = self._savedMaskVersions.get(k) == layer.maskVersion
+            if is_saved and not layer.isVisible and layer is not self.activeLayer:
+                layer.unload()
+
     def get_layer_by_z(self, z):
         return self.get_layer_by_uid(self.layerKeys[z])
 
@@ -96,40 +180,96 @@ class ProjectModel:
             vis.append(self.get_layer_by_z(z).isVisible)
         return vis
 
-    def export_comp_image(self, pil_image):
+    def get_comp_image_path(self):
         if not os.path.exists(self.compRootDir):
             os.mkdir(self.compRootDir)
-        outfile = os.path.join(self.compRootDir, self._generate_comp_file_name(self.projectName))
-        pil_image.save(outfile)
+        return os.path.join(self.compRootDir, self._generate_comp_file_name(self.projectName))
 
-    def save_as(self, project_file_path):
-        self._set_paths(project_file_path)
-        self._save_project_json()
-        self._save_masks()
+    def get_journal_path(self):
+        # a single file project keeps its journal next to it, and has no mask dir
+        journal_dir = os.path.dirname(self.projectPath) if self.isContainer else self.maskRootDir
+        return os.path.join(journal_dir, self._generate_journal_file_name(self.projectName))
 
-        # model will use subject to update observer views
+    def get_project_dict(self):
+        # the project json data, without the masks
+        json_layers = {}
+        for i in range(self.numMasks):
+            k = self.layerKeys[i]
+            layer = self.layers[k]
+            json_layers[k] = {"name": layer.name,
+                              "color": layer.color,
+                              "visible": layer.isVisible,
+                              "locked": layer.isLocked}
+
+        return {
+            "project_name": self.projectName,
+            "layer_keys": self.layerKeys,
+            "layers": json_layers,
+            "active_mask": self.activeMask,
+            "mask_opaque": self.maskOpaque
+        }
+
+    def set_project_dict(self, dictionary):
+        # restore the project json data of get_project_dict, a layer not in the project gets an empty mask
+        w, h = self.imgSize
+        layers = dict()
+        for k in dictionary["layer_keys"]:
+            json_layer = dictionary["layers"][k]
+            if k in self.layers:
+                layer = self.layers[k]
+                layer.name = json_layer["name"]
+                layer.color = json_layer["color"]
+                layer.isVisible = json_layer["visible"]
+                layer.isLocked = json_layer["locked"]
+            else:
+                layer = Layer(json_layer, DiskMask.zeros((h, w)), self._get_mask_loader(k))
+            layers[k] = layer
+
+        self.layers = layers
+        self.layerKeys = list(dictionary["layer_keys"])
+        self.numMasks = len(self.layerKeys)
+        self.activeMask = dictionary["active_mask"]
+        self.activeLayer = self.get_layer_by_z(self.activeMask) if self.activeMask >= 0 else None
+        self.maskOpaque = dictionary["mask_opaque"]
+
+    def set_project_path(self, project_file_path):
+        # the project will be saved to a new path, nothing is saved there yet
+        # the layers not read yet are read from the old path first, their loaders follow the project path
+        self.map_masks(Layer.load, [self.layers[k] for k in self.layerKeys if not self.layers[k].is_loaded()])
+        self._set_paths(project_file_path)
+        EditJournal.remove(self.get_journal_path())
+        self._savedMaskVersions = dict()
 
     def save(self):
-        self._save_project_json()
-        self._save_masks()
+        # save on the calling thread
+        writer = ProjectWriter(self)
+        writer.write()
+        self.set_saved(writer)
+
+    def set_saved(self, writer):
+        # the writer is done, its snapshot of the masks is on disk
+        self._savedMaskVersions = dict(writer.maskVersions)
 
     def create_project(self, project_file_path, bg_image_file_path=None):
         self.unload()
         self._set_paths(project_file_path)
+        EditJournal.remove(self.get_journal_path())
 
         config = self._read_default_config(self._config_file_path)
         bg_img_size = self._copy_background_image(config, bg_image_file_path)
         self._process_config(config, bg_img_size)
 
-        self._save_project_json()
-        self._save_masks()
+        self.save()
 
         # model will use subject to update observer views
 
     def load_project(self, project_file_path):
         self.unload()
         self._set_paths(project_file_path)
-        self._read_project_json(project_file_path)
+        if self.isContainer:
+            self._read_container()
+        else:
+            self._read_project_json(project_file_path)
 
         # model will use subject to update observer views
 
@@ -137,6 +277,7 @@ class ProjectModel:
         self.projectPath = project_file_path
         project_root_dir, self.projectFileName = os.path.split(self.projectPath)
         self.projectName = self.projectFileName.split('.')[0]
+        self.isContainer = self.projectFileName.lower().endswith(self.containerExtension)
         self.compRootDir = os.path.join(project_root_dir, self._comp_dir)
         self.maskRootDir = os.path.join(project_root_dir, self._mask_dir)
 
@@ -149,8 +290,9 @@ class ProjectModel:
 
     def _copy_background_image(self, config, bg_image_file_path):
         # returns img_size (w, h) if bg_image exists, otherwise returns None
+        # a single file project keeps the background only in the container, no image files are written
         if bg_image_file_path:
-            if not os.path.exists(self.maskRootDir):
+            if not self.isContainer and not os.path.exists(self.maskRootDir):
                 os.mkdir(self.maskRootDir)
             cv_bg = cv.imread(bg_image_file_path)
             h = cv_bg.shape[0]
@@ -161,17 +303,19 @@ class ProjectModel:
             w_over = w / config.max_background_width
             over = max(h_over, w_over)
             if over > 1.0:
-                large_bg_filename = self._generate_large_background_file_name(self.projectName)
-                large_bg_path = os.path.join(self.maskRootDir, large_bg_filename)
-                cv.imwrite(large_bg_path, cv_bg)
+                if not self.isContainer:
+                    large_bg_filename = self._generate_large_background_file_name(self.projectName)
+                    large_bg_path = os.path.join(self.maskRootDir, large_bg_filename)
+                    cv.imwrite(large_bg_path, cv_bg)
 
                 h = int(h / over)
                 w = int(w / over)
                 cv_bg = cv.resize(cv_bg, (w, h))
 
-            bg_filename = self._generate_background_file_name(self.projectName)
-            self.backgroundImagePath = os.path.join(self.maskRootDir, bg_filename)
-            cv.imwrite(self.backgroundImagePath, cv_bg)
+            if not self.isContainer:
+                self.backgroundImagePath = self.get_background_path()
+                cv.imwrite(self.backgroundImagePath, cv_bg)
+            self.cvBackgroundImage = cv.cvtColor(cv_bg, cv.COLOR_BGR2RGBA)
 
             return w, h
         return None
@@ -193,7 +337,7 @@ class ProjectModel:
 
         for i in range(self.numMasks):
             k = self.layerKeys[i]
-            mask = np.zeros((h, w, 3), dtype=np.uint8)
+            mask = DiskMask.zeros((h, w))
             layer = layers[k].__dict__
             self.layers[k] = Layer(layer, mask)
 
@@ -206,13 +350,25 @@ class ProjectModel:
 
         # use a background image if it exists in the mask dir
         if os.path.exists(self.maskRootDir):
-            bg_filename = self._generate_background_file_name(self.projectName)
-            bg_file_path = os.path.join(self.maskRootDir, bg_filename)
+            bg_file_path = self.get_background_path()
             if os.path.exists(bg_file_path):
                 cv_bg = cv.imread(bg_file_path)
                 self.cvBackgroundImage = cv.cvtColor(cv_bg, cv.COLOR_BGR2RGBA)
                 self.backgroundImagePath = bg_file_path
 
+        self._read_layers(obj)
+
+    def _read_container(self):
+        with zipfile.ZipFile(self.projectPath) as container:
+            obj = json.loads(container.read(self.containerProjectName),
+                             object_hook=lambda d: SimpleNamespace(**d))
+            if self.containerBackgroundName in container.namelist():
+                with container.open(self.containerBackgroundName) as bg_file:
+                    self.cvBackgroundImage = np.load(bg_file)
+
+        self._read_layers(obj)
+
+    def _read_layers(self, obj):
         # derive data from project file
         self.activeMask = obj.active_mask
         self.maskOpaque = obj.mask_opaque
@@ -220,55 +376,87 @@ class ProjectModel:
         self.layerKeys = obj.layer_keys
         layers = obj.layers.__dict__
 
+        # only the visible and the active layers are read now, for the first frame, the others are read on use
+        loaded_keys = [k for i, k in enumerate(self.layerKeys) if layers[k].visible or i == self.activeMask]
+        masks = dict(zip(loaded_keys, self.map_masks(self._read_mask, loaded_keys)))
         for i in range(self.numMasks):
             k = self.layerKeys[i]
-            mask_filename = self._generate_mask_file_name(self.projectName, k)
-            mask_path = os.path.join(self.maskRootDir, mask_filename)
-            cv_mask_bgr = cv.imread(mask_path)
-            cv_mask = cv.cvtColor(cv_mask_bgr, cv.COLOR_BGR2GRAY)
-
             layer = layers[k].__dict__
-            self.layers[k] = Layer(layer, cv_mask)
+            self.layers[k] = Layer(layer, masks.get(k), self._get_mask_loader(k))
 
             if self.activeMask == i:
                 self.activeLayer = self.layers[k]
 
         # fill in the missing data
-        mask0 = self.layers[self.layerKeys[0]].cvMask
+        mask0 = self.layers[loaded_keys[0] if loaded_keys else self.layerKeys[0]].cvMask
         self.imgSize = (mask0.shape[1], mask0.shape[0])
+        self._savedMaskVersions = {k: self.layers[k].maskVersion for k in self.layerKeys}
+
+    def _get_mask_loader(self, k):
+        # the saved mask of the layer, read from wherever the project is saved when it is used
+        return lambda: self._read_mask(k)
+
+    def _load_layers(self, layers):
+        for layer in layers:
+            try:
+                layer.load()
+            except Exception:
+                # the project was closed or moved, the layer is read when it is used
+                return
+
+    def _read_mask(self, k):
+        return ProjectModel._read_mask_source(self._get_mask_source(k))
+
+    def _get_mask_source(self, k):
+        # (True, container path, member name) of a single file project, (False, mask path, jpg mask path) otherwise
+        if self.isContainer:
+            return True, self.projectPath, self.get_container_mask_name(k)
+        jpg_path = os.path.join(self.maskRootDir, self._generate_jpg_mask_file_name(self.projectName, k))
+        return False, self.get_mask_path(k), jpg_path
 
-    def _save_project_json(self):
-        # build a json from python data
-        # save json to file
-
-        json_layers = {}
-        for i in range(self.numMasks):
-            k = self.layerKeys[i]
-            layer = self.layers[k]
-            json_layers[k] = {"name": layer.name,
-                              "color": layer.color,
-                              "visible": layer.isVisible,
-                              "locked": layer.isLocked}
-
-        dictionary = {
-            "project_name": self.projectName,
-            "layer_keys": self.layerKeys,
-            "layers": json_layers,
-            "active_mask": self.activeMask,
-            "mask_opaque": self.maskOpaque
-        }
+    @staticmethod
+    def _read_mask_source(source):
+        # read the mask of one layer, without reading the other layers, a large mask is moved to disk
+        is_container, path, name = source
+        if is_container:
+            with zipfile.ZipFile(path) as container:
+                data = container.read(name)
+        else:
+            mask_path, jpg_path = path, name
+            if not os.path.exists(mask_path):
+                return DiskMask.from_array(ProjectModel._migrate_jpg_mask(mask_path, jpg_path))
+            with open(mask_path, 'rb') as file:
+                data = file.read()
+
+        # the decoder holds about twice a whole mask in memory, so large masks are decoded one at a time
+        is_large = DiskMask.is_large(ProjectModel._get_png_shape(data))
+        with ProjectModel._large_mask_lock if is_large else contextlib.nullcontext():
+            with Tracer.span("read_mask"):
+                cv_mask = cv.imdecode(np.frombuffer(data, dtype=np.uint8), cv.IMREAD_GRAYSCALE)
+            if cv_mask is None:
+                raise IOError("could not decode mask {}".format(path))
+            return DiskMask.from_array(cv_mask)
 
-        with open(self.projectPath, 'w') as outfile:
-            json.dump(dictionary, outfile, indent=4)
-        outfile.close()
+    @staticmethod
+    def _get_png_shape(data):
+        # (h, w) from the png header, without decoding the image
+        if data[:8] != b'\x89PNG\r\n\x1a\n':
+            return 0, 0
+        w, h = struct.unpack('>II', data[16:24])
+        return h, w
 
-    def _save_masks(self):
-        if not os.path.exists(self.maskRootDir):
-            os.mkdir(self.maskRootDir)
-        for i in range(self.numMasks):
-            k = self.layerKeys[i]
-            mask_filename = self._generate_mask_file_name(self.projectName, k)
-            cv.imwrite(os.path.join(self.maskRootDir, mask_filename), self.layers[k].cvMask)
+    @staticmethod
+    def _migrate_jpg_mask(mask_path, jpg_path):
+        # a jpg mask has compression artifacts around every edge, threshold it back to a binary mask
+        # the jpg is removed only after the png is written
+        with Tracer.span("read_mask"):
+            cv_mask = cv.imread(jpg_path, cv.IMREAD_GRAYSCALE)
+        if cv_mask is None:
+            raise IOError("missing mask {}".format(mask_path))
+        _, cv_mask = cv.threshold(cv_mask, 127, 255, cv.THRESH_BINARY)
+        ProjectWriter.write_mask(mask_path, cv_mask)
+        os.remove(jpg_path)
+        return cv_mask
 
     def insert_layer(self, z, color=None):
         if not color:
@@ -281,15 +469,14 @@ class ProjectModel:
                     color = Utils.average_hex_colors(self.get_layer_by_z(z-1).color, self.get_layer_by_z(z).color)
 
         w, h = self.imgSize
-        cv_mask_bgr = np.zeros((h, w, 3), dtype=np.uint8)
-        cv_mask = cv.cvtColor(cv_mask_bgr, cv.COLOR_BGR2GRAY)
+        cv_mask = DiskMask.zeros((h, w))
         uid = self._generate_layer_uid()
 
         json_layer = {"name": "New Layer",
                       "color": color,
                       "visible": True,
                       "locked": False}
-        self.layers[str(uid)] = Layer(json_layer, cv_mask)
+        self.layers[str(uid)] = Layer(json_layer, cv_mask, self._get_mask_loader(str(uid)))
         if z < self.numMasks:
             self.layerKeys.insert(z, str(uid))
         else:
@@ -301,6 +488,8 @@ class ProjectModel:
 
     def remove_layer(self, z):
         uid = self.layerKeys[z]
+        # the next save deletes the saved mask, so undo needs it in memory
+        self.layers[uid].load()
         self.layerKeys.pop(z)
         del self.layers[uid]
 
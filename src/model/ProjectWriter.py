@@ -0,0 +1,157 @@
+"""
+Writes a project to disk on a worker thread, from a snapshot taken on the calling thread.
+
+- the constructor copies the masks changed since the last save and the project json data,
+    so the editor can keep painting while the project is written
+- every file is written and synced to a temp file first, the temp files replace the project files
+    only once all of them are complete, the project json last, so a failed save never leaves a torn mask file
+- a single file project is one temp file that replaces the container
+- maskVersions are the layer mask versions of the snapshot, the project marks them saved when the writer is done,
+    layers painted during the save stay changed for the next one
+"""
+
+import json
+import os
+import threading
+import zipfile
+import cv2 as cv
+import numpy as np
+
+from src.Tracer import Tracer
+from src.model.DiskMask import DiskMask
+from src.model.MaskCodec import MaskCodec
+
+
+class ProjectWriter:
+    def __init__(self, project):
+        self.projectPath = project.projectPath
+        self.isContainer = project.isContainer
+        self.maskVersions = {k: project.layers[k].maskVersion for k in project.layerKeys}
+        self.isDone = False
+        self.error = None
+
+        with Tracer.span("save_snapshot"):
+            self._json = json.dumps(project.get_project_dict(), indent=4)
+            self._masks = {k: DiskMask.copy(project.layers[k].cvMask) for k in project.get_dirty_keys()}
+        self._keys = list(project.layerKeys)
+        self._map_masks = project.map_masks
+
+        # the background never changes in place, so it is shared
+        self._background = project.cvBackgroundImage
+        self._container_project_name = project.containerProjectName
+        self._container_background_name = project.containerBackgroundName
+        self._container_mask_names = {k: project.get_container_mask_name(k) for k in self._keys}
+
+        self._mask_root_dir = project.maskRootDir
+        self._mask_paths = {k: project.get_mask_path(k) for k in self._keys}
+        self._background_path = project.get_background_path()
+        self._removed_mask_paths = [project.get_mask_path(k) for k in project.get_removed_keys()]
+        self._thread = None
+
+    def start(self):
+        # not a daemon, so closing the app waits for the save to finish
+        self._thread = threading.Thread(target=self._run, name='ProjectWriter')
+        self._thread.start()
+
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    def write(self):
+        # save on the calling thread
+        if self.isContainer:
+            self._write_container()
+        else:
+            self._write_files()
+
+    @staticmethod
+    def encode_mask(cv_mask):
+        # painted masks are 0 or 255 and are encoded as 1 bit png, anything else as lossless 8 bit png
+        # checked in strips, so a large mask on disk is never checked all at once in memory
+        strips = range(0, cv_mask.shape[0], DiskMask.stripRows)
+        if all(MaskCodec.is_binary(cv_mask[top:top + DiskMask.stripRows]) for top in strips):
+            params = [cv.IMWRITE_PNG_BILEVEL, 1]
+        else:
+            params = []
+        is_ok, data = cv.imencode(".png", cv_mask, params)
+        if not is_ok:
+            raise IOError("could not encode mask")
+        return data.tobytes()
+
+    @staticmethod
+    def write_mask(mask_path, cv_mask):
+        with Tracer.span("write_mask"):
+            ProjectWriter._write_file(mask_path, ProjectWriter.encode_mask(cv_mask))
+
+    ###########################################################################
+    #
+    #  helpers
+    #
+    ###########################################################################
+
+    def _run(self):
+        try:
+            self.write()
+        except Exception as e:
+            self.error = e
+        self.isDone = True
+
+    def _write_files(self):
+        if not os.path.exists(self._mask_root_dir):
+            os.mkdir(self._mask_root_dir)
+
+        keys = list(self._masks)
+        temp_paths = [self._mask_paths[k] + '.tmp' for k in keys]
+        self._map_masks(ProjectWriter.write_mask, temp_paths, [self._masks[k] for k in keys])
+        replaced_paths = [self._mask_paths[k] for k in keys]
+
+        # a project saved to a new name or converted from a single file project has no background file there yet
+        if self._background is not None and not os.path.exists(self._background_path):
+            is_ok, data = cv.imencode(".jpg", cv.cvtColor(self._background, cv.COLOR_RGBA2BGR))
+            if not is_ok:
+                raise IOError("could not encode background")
+            temp_paths.append(self._background_path + '.tmp')
+            replaced_paths.append(self._background_path)
+            ProjectWriter._write_file(temp_paths[-1], data.tobytes())
+        ProjectWriter._write_file(self.projectPath + '.tmp', self._json.encode('utf-8'))
+
+        for temp_path, file_path in zip(temp_paths, replaced_paths):
+            os.replace(temp_path, file_path)
+        os.replace(self.projectPath + '.tmp', self.projectPath)
+
+        # delete the masks of removed layers, undo can restore such a layer, it is then written again
+        for mask_path in self._removed_mask_paths:
+            if os.path.exists(mask_path):
+                os.remove(mask_path)
+
+    def _write_container(self):
+        # unchanged masks are copied from the old container without encoding them again
+        keys = list(self._masks)
+        data = dict(zip(keys, self._map_masks(ProjectWriter.encode_mask, [self._masks[k] for k in keys])))
+        if len(data) < len(self._keys):
+            with zipfile.ZipFile(self.projectPath) as old_container:
+                for k in self._keys:
+                    if k not in data:
+                        data[k] = old_container.read(self._container_mask_names[k])
+
+        # png and npy members are stored, the png data is already compressed
+        temp_path = self.projectPath + '.tmp'
+        with Tracer.span("write_container"):
+            with open(temp_path, 'wb') as file:
+                with zipfile.ZipFile(file, 'w', zipfile.ZIP_STORED) as container:
+                    container.writestr(self._container_project_name, self._json)
+                    if self._background is not None:
+                        with container.open(self._container_background_name, 'w') as bg_file:
+                            np.save(bg_file, self._background)
+                    for k in self._keys:
+                        container.writestr(self._container_mask_names[k], data[k])
+                file.flush()
+                os.fsync(file.fileno())
+        os.replace(temp_path, self.projectPath)
+
+    @staticmethod
+    def _write_file(file_path, data):
+        with open(file_path, 'wb') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
@@ -0,0 +1,123 @@
+"""
+Undo entries change the project in place instead of replacing it with a deep copy.
+
+- apply(project) restores the state the entry holds and returns the entry that restores the state it replaced,
+    so the same call moves an entry from the undo stack to the redo stack and back
+- a mask patch holds only the before-pixels of the tiles a brush stroke touched, for the one edited layer
+    the tiles are kept raw while the stroke is painted, and compressed with MaskCodec once it ends
+- a field entry holds only the values of a few layer or project fields, for property changes like color,
+    visibility or the layer order, it costs no mask memory
+- a project state holds the layer order, the layer fields and the project fields, for adding and removing layers
+    it keeps references to the layer objects instead of copies, each layer keeps its own mask,
+    masks only ever change in place by strokes, and the stroke patches above it on the stack undo those first
+- nbytes is the memory an entry holds, for the byte budget of UndoHistory
+"""
+
+from src.model.MaskCodec import MaskCodec
+
+
+class MaskPatchEntry:
+    def __init__(self, layer_uid, tile_size=64):
+        self.layerUid = layer_uid
+        self.tile_size = tile_size
+
+        # (row, col) -> pixels of that tile of the mask, raw while recording, MaskCodec encoded once compressed
+        self.tiles = dict()
+        self.nbytes = 0
+
+    def is_empty(self):
+        return not self.tiles
+
+    def record(self, mask, window):
+        # save the before-pixels of every tile in the window (left, top, right, bottom) not saved yet
+        # call before drawing into the window
+        h, w = mask.shape[:2]
+        t = self.tile_size
+        left, top, right, bottom = window
+        for row in range(max(0, top) // t, (min(h, bottom) + t - 1) // t):
+            for col in range(max(0, left) // t, (min(w, right) + t - 1) // t):
+                if (row, col) not in self.tiles:
+                    self.tiles[(row, col)] = mask[row * t:(row + 1) * t, col * t:(col + 1) * t].copy()
+
+    def compress(self):
+        # call once the stroke ended and no more tiles are recorded
+        self.tiles = {key: MaskCodec.encode(pixels) for key, pixels in self.tiles.items()}
+        self.nbytes = sum(MaskCodec.nbytes(encoded) for encoded in self.tiles.values())
+
+    def apply(self, project):
+        layer = project.get_layer_by_uid(self.layerUid)
+        t = self.tile_size
+        nbytes = 0
+        for (row, col), encoded in self.tiles.items():
+            region = layer.cvMask[row * t:(row + 1) * t, col * t:(col + 1) * t]
+            current = MaskCodec.encode(region)
+            region[:] = MaskCodec.decode(encoded)
+            self.tiles[(row, col)] = current
+            nbytes += MaskCodec.nbytes(current)
+        self.nbytes = nbytes
+        layer.bump_mask_version()
+        return self
+
+
+class FieldEntry:
+    def __init__(self, project, targets):
+        # targets are (layer uid, field name) pairs, a uid of None means a field of the project
+        self.targets = targets
+        self.values = [FieldEntry._get(project, uid, field) for uid, field in targets]
+        self.nbytes = 64 + 64 * len(targets)
+
+    def apply(self, project):
+        inverse = FieldEntry(project, self.targets)
+        for (uid, field), value in zip(self.targets, self.values):
+            if uid is None:
+                setattr(project, field, list(value) if isinstance(value, list) else value)
+            else:
+                setattr(project.get_layer_by_uid(uid), field, value)
+
+        # the active layer follows the active index and the layer order
+        if any(uid is None and field in ("activeMask", "layerKeys") for uid, field in self.targets):
+            project.activeLayer = project.get_layer_by_z(project.activeMask)
+        return inverse
+
+    @staticmethod
+    def _get(project, uid, field):
+        if uid is None:
+            value = getattr(project, field)
+            return list(value) if isinstance(value, list) else value
+        return getattr(project.get_layer_by_uid(uid), field)
+
+
+class ProjectStateEntry:
+    def __init__(self, project):
+        self.layers = dict(project.layers)
+        self.layerFields = {uid: (layer.name, layer.color, layer.isVisible, layer.isLocked)
+                            for uid, layer in project.layers.items()}
+        self.layerKeys = list(project.layerKeys)
+        self.activeMask = project.activeMask
+        self.maskOpaque = project.maskOpaque
+
+        # rough python object overhead, the masks belong to the layers and are not counted
+        self.nbytes = 256 + 256 * len(self.layers)
+
+    def apply(self, project):
+        inverse = ProjectStateEntry(project)
+
+        # a layer that leaves the project is read first, saving deletes its mask file and the inverse restores it
+        for uid, layer in project.layers.items():
+            if uid not in self.layers:
+                layer.load()
+
+        for uid, layer in self.layers.items():
+            name, color, is_visible, is_locked = self.layerFields[uid]
+            layer.name = name
+            layer.color = color
+            layer.isVisible = is_visible
+            layer.isLocked = is_locked
+
+        project.layers = dict(self.layers)
+        project.layerKeys = list(self.layerKeys)
+        project.numMasks = len(project.layerKeys)
+        project.activeMask = self.activeMask
+        project.activeLayer = project.get_layer_by_z(self.activeMask) if self.activeMask >= 0 else None
+        project.maskOpaque = self.maskOpaque
+        return inverse
@@ -1,12 +1,20 @@
+from collections import deque
+
+
+# the stacks hold undo entries, applying an entry to the project returns the entry that reverses it
+# undo and redo return the entry they pushed to the other stack, it holds the same targets as the one applied
+# the history is bounded by the bytes its entries hold, the oldest undo entries are dropped first
 class UndoHistory:
-    def __init__(self, limit):
-        self._undo_limit = limit
-        self._undo_stack = []
-        self._redo_stack = []
+    def __init__(self, limit_bytes):
+        self._limit_bytes = limit_bytes
+        self._nbytes = 0
+        self._undo_stack = deque()
+        self._redo_stack = deque()
 
     def reset(self):
         self._undo_stack.clear()
         self._redo_stack.clear()
+        self._nbytes = 0
 
     def has_undo(self):
         return len(self._undo_stack) > 0
@@ -14,16 +22,40 @@ class UndoHistory:
     def has_redo(self):
         return len(self._redo_stack) > 0
 
-    def save_state(self, state):
-        self._undo_stack.insert(0, state)
+    def save_state(self, entry):
+        self._nbytes -= sum(e.nbytes for e in self._redo_stack)
         self._redo_stack.clear()
-        while len(self._undo_stack) > self._undo_limit:
-            self._undo_stack.pop(self._undo_limit)
+        self._push(self._undo_stack, entry)
+
+    def undo(self, project):
+        entry = self._pop(self._undo_stack)
+        inverse = entry.apply(project)
+        self._push(self._redo_stack, inverse)
+        return inverse
+
+    def redo(self, project):
+        entry = self._pop(self._redo_stack)
+        inverse = entry.apply(project)
+        self._push(self._undo_stack, inverse)
+        return inverse
+
+    ###########################################################################
+    #
+    #  helpers
+    #
+    ###########################################################################
+
+    def _push(self, stack, entry):
+        stack.appendleft(entry)
+        self._nbytes += entry.nbytes
+        self._evict()
 
-    def undo(self, current_state):
-        self._redo_stack.insert(0, current_state)
-        return self._undo_stack.pop(0)
+    def _pop(self, stack):
+        entry = stack.popleft()
+        self._nbytes -= entry.nbytes
+        return entry
 
-    def redo(self, current_state):
-        self._undo_stack.insert(0, current_state)
-        return self._redo_stack.pop(0)
+    def _evict(self):
+        # the newest undo entry is always kept, even if it alone is over the limit
+        while self._nbytes > self._limit_bytes and len(self._undo_stack) > 1:
+            self._nbytes -= self._undo_stack.pop().nbytes
@@ -1,67 +1,108 @@
 from tkinter import *
-from PIL import ImageTk, Image
 import cv2 as cv
 import numpy as np
+import time
+
+from src.Tracer import Tracer
+from src.view.ZoomEngine import ZoomEngine
+from src.view.TileRenderer import TileRenderer
+from src.view.DisplaySurface import DisplaySurface
+from src.view.ExportRenderer import ExportRenderer
 
 
 class CanvasPainter:
     def __init__(self, canvas, model):
         self.canvas = canvas
         self.model = model
+        self.model.subject.load.attach(self._update_load)
         self.model.subject.project.attach(self._update_project)
         self.model.subject.layer.attach(self._update_layer)
 
         # constants
         self._color_paint = 'white'
         self._color_erase = 'black'
+        self._surface = DisplaySurface(canvas, 'frame')
+        self._tile_renderer = TileRenderer()
+        self._frame_interval = 1 / 60.0
+        self._export_poll_interval_ms = 100
 
         # vars needing reset
-        self._bg_comp = None
-        self._fg_comp = None
+        self._frame = None
+        self._brush_outline = None
         self._brush_position = None
         self._pan_position = None
+        self._dirty_window = None
+        self._dirty_time = None
+        self._flush_id = None
+
+    def _update_load(self):
+        # cached tiles belong to the previous project
+        self._tile_renderer.reset()
+
+        # hidden layers are read in the background once the first frame is drawn
+        if self.model.isProjectLoaded:
+            self.canvas.after_idle(self.model.project.load_layers_in_background)
 
     def _update_project(self):
         if self.model.isProjectLoaded:
-            if self.model.project.backgroundImagePath:
-                self._bg_image = Image.open(self.model.project.backgroundImagePath).convert('RGBA')
             self._update_layer()
         else:
+            self._clear_dirty()
             self.canvas.delete(ALL)
+            self._surface.reset()
+            self._brush_outline = None
 
     def _update_layer(self):
-        self._bg_comp = self._comp_bg_image()
-        if self.model.project.maskOpaque:
-            self._fg_comp = self._comp_fg_image()
         self.render_canvas_image()
 
     def render_canvas_image(self):
-        active_layer_image = self._get_masked_image(self.model.project.activeMask)
-        composite = Image.alpha_composite(self._bg_comp, active_layer_image)
-        if self.model.project.maskOpaque:
-            composite = Image.alpha_composite(composite, self._fg_comp)
-        else:
-            # if masks are transparent, all layers in front of the active layer need to be re-rendered
-            #   immediately after the active layer is re-rendered
-            #   and ignore the _fg_comp since that only works for opaque masks
-            for i in range(self.model.project.activeMask + 1, self.model.project.numMasks):
-                layer_image = self._get_masked_image(i)
-                composite = Image.alpha_composite(composite, layer_image)
+        # a full render covers any pending dirty region
+        self._clear_dirty()
 
-        self.canvas.delete(ALL)
+        # keep the full composite as the persistent frame that dirty regions are pasted into
+        with Tracer.frame("full_frame"):
+            self._frame = self._render_window(self._viewport_window())
+            self._show_frame()
 
-        # convert the PIL image to TK PhotoImage
-        # set the canvas.image property, it wont work without this step
-        self.canvas.image = ImageTk.PhotoImage(composite)
-        self.canvas.create_image(self.model.canvas.cs_crop_x, self.model.canvas.cs_crop_y,
-                                 image=self.canvas.image, anchor=NW)
+    def _show_frame(self):
+        self._surface.show(self._frame, self.model.canvas.cs_crop_x, self.model.canvas.cs_crop_y)
 
         # for debugging
         # self.render_camera_outline()
 
+    def render_canvas_region(self, window):
+        # re-render only the mask space window (left, top, right, bottom) into the persistent frame
+        # and push only that patch to the tk image
+        window = self._clip_to_viewport(self.model.canvas.mask_to_level_window(window))
+        if not window or self._frame is None:
+            return
+        left, top, right, bottom = window
+        zoom = self.model.canvas.level_zoom
+        x = (left - self.model.canvas.ms_zoom_left) * zoom
+        y = (top - self.model.canvas.ms_zoom_top) * zoom
+
+        with Tracer.frame("region_frame"):
+            patch = self._tile_renderer.render_region(self.model.project, window, self.model.canvas.level)
+            patch = ZoomEngine.zoom_image(patch, zoom)
+            h, w = patch.shape[:2]
+            self._frame[y:y + h, x:x + w] = patch
+
+            # copy only the patch into the tk image
+            self._surface.update_region(patch, x, y)
+
     def render_brush_outline(self, x, y):
+        # the outline is one persistent canvas item that is only moved and resized
+        # so mouse motion never touches the composited image
         r = self.model.brushSize * self.model.canvas.zoom
-        self.canvas.create_oval(x - r, y - r, x + r, y + r)
+        if self._brush_outline is None:
+            self._brush_outline = self.canvas.create_oval(x - r, y - r, x + r, y + r)
+        else:
+            self.canvas.coords(self._brush_outline, x - r, y - r, x + r, y + r)
+            self.canvas.itemconfigure(self._brush_outline, state=NORMAL)
+
+    def hide_brush_outline(self):
+        if self._brush_outline is not None:
+            self.canvas.itemconfigure(self._brush_outline, state=HIDDEN)
 
     def render_camera_outline(self):
         # for debugging zoom, render camera center
@@ -71,18 +112,11 @@ class CanvasPainter:
         self.canvas.create_rectangle(x - r, y - r, x + r, y + r)
 
     def export_comp_image(self):
-        old_zoom = self.model.canvas.zoom
-        self.model.canvas.set_zoom(1)
-
-        temp_bg = self._comp_bg_image(show_all=True)
-        temp_fg = self._comp_fg_image(show_all=True)
-        temp_active_layer_image = self._get_masked_image(self.model.project.activeMask, show_all=True)
-        composite = Image.alpha_composite(temp_bg, temp_active_layer_image)
-        composite = Image.alpha_composite(composite, temp_fg)
-
-        # send the PIL image to the model to save to disk
-        self.model.export_comp_image(composite)
-        self.model.canvas.set_zoom(old_zoom)
+        # the full resolution composite is rendered from a snapshot of the project on a worker thread
+        # so the export never touches the view and the editor stays responsive
+        export = ExportRenderer(self.model.project)
+        export.start(self.model.project.get_comp_image_path())
+        self.canvas.after(self._export_poll_interval_ms, self._poll_export, export)
 
     def zoom(self, e):
         self._update_project()
@@ -92,12 +126,17 @@ class CanvasPainter:
         self._update_layer()
 
     def pan(self, e):
+        # the scrolled frame is reused, so it must be up to date first
+        self._flush_dirty()
+        self.hide_brush_outline()
         if self._pan_position:
             old_x, old_y = self._pan_position
             dx = old_x - e.x
             dy = old_y - e.y
+            old_window = self._viewport_window()
             self.model.canvas.move_camera_position(dx, dy)
-            self._update_layer()
+            if not self._scroll_frame(old_window):
+                self.render_canvas_image()
         self._pan_position = (e.x, e.y)
 
     def end_pan(self, _):
@@ -110,7 +149,9 @@ class CanvasPainter:
         self._edit_active_mask(e, (0, 0, 0))
 
     def end_brush_stroke(self, _):
+        self._flush_dirty()
         self._brush_position = None
+        self.model.end_mask_edit()
         if self.model.isCurrentSaved:
             self.model.set_mask_edited()
 
@@ -122,84 +163,128 @@ class CanvasPainter:
 
     def _edit_active_mask(self, e, color):
         active_layer = self.model.project.activeLayer
-        x, y = self.model.canvas.mouse_canvas_to_world(e)
-        x = x // self.model.canvas.zoom
-        y = y // self.model.canvas.zoom
+        x, y = self.model.canvas.mouse_canvas_to_mask(e)
 
         if active_layer.isVisible and not active_layer.isLocked:
+            r = self.model.brushSize
             if self._brush_position:
                 bx, by = self._brush_position
-                cv.line(active_layer.cvMask, (bx, by), (x, y), color, self.model.brushSize * 2)
             else:
-                self.model.save_undo_state()
-            cv.circle(active_layer.cvMask, (x, y), self.model.brushSize, color, -1)
+                bx, by = x, y
+                self.model.begin_mask_edit()
+
+            # the segment only changes the box around the line and its round caps
+            # pad by a pixel so the rasterized edges are always inside the box
+            window = (min(bx, x) - r - 1, min(by, y) - r - 1, max(bx, x) + r + 2, max(by, y) + r + 2)
+            self.model.record_mask_edit(window)
+
+            if self._brush_position:
+                cv.line(active_layer.cvMask, (bx, by), (x, y), color, r * 2)
+            cv.circle(active_layer.cvMask, (x, y), r, color, -1)
+            active_layer.bump_mask_version()
+            self._tile_renderer.mask_edited(active_layer, window)
+            self._add_dirty(window)
 
-        self.render_canvas_image()
         self.render_brush_outline(e.x, e.y)
         self._brush_position = (x, y)
 
-    def _get_zoom_cv(self, cv_image):
-        zoom_img = cv_image[
-                   self.model.canvas.ms_zoom_top:self.model.canvas.ms_zoom_bottom,
-                   self.model.canvas.ms_zoom_left:self.model.canvas.ms_zoom_right,
-                   :
-        ]
-        zoom = self.model.canvas.zoom
-        if zoom > 1:
-            zoom_img = np.kron(zoom_img, np.ones((zoom, zoom, 1), dtype=np.uint8))
-        return zoom_img
-
-    def _get_zoom_cv_bg_image(self):
-        ws_zoom_size = self.model.canvas.ws_zoom_size()
-        cv_bg = self.model.project.cvBackgroundImage
-        zoom_cv_bg = self._get_zoom_cv(cv_bg)
-        image = Image.fromarray(zoom_cv_bg)
-        image.resize(ws_zoom_size)
-        return image
-
-    def _get_mask(self, cv_mask):
-        zoom_img = cv_mask[
-                   self.model.canvas.ms_zoom_top:self.model.canvas.ms_zoom_bottom,
-                   self.model.canvas.ms_zoom_left:self.model.canvas.ms_zoom_right
-        ]
-        zoom = self.model.canvas.zoom
-        if zoom > 1:
-            zoom_img = np.kron(zoom_img, np.ones((zoom, zoom), dtype=np.uint8))
-        return zoom_img
-
-    def _get_masked_image(self, mask_num, show_all=False):
-        ws_zoom_size = self.model.canvas.ws_zoom_size()
-        if mask_num < self.model.project.numMasks:
-            layer = self.model.project.get_layer_by_z(mask_num)
-            if self.model.project.maskOpaque:
-                mask = Image.fromarray(self._get_mask(layer.cvMask))
-            else:
-                mask = Image.fromarray(self._get_mask(layer.cvMask) // 2)
-            mask.convert('L').resize(ws_zoom_size)
-            image = Image.new('RGBA', ws_zoom_size, layer.color)
-            if layer.isVisible or show_all:
-                image.putalpha(mask)
-            else:
-                image.putalpha(0)
-            return image
-        else:
-            image = Image.new('RGBA', ws_zoom_size, 'magenta')
-            image.putalpha(0)
-            return image
-
-    def _comp_bg_image(self, show_all=False):
-        if self.model.project.backgroundImagePath:
-            composite = self._get_zoom_cv_bg_image()
+    def _add_dirty(self, window):
+        # every segment is already in the mask, only the screen update is deferred
+        # motion events can arrive much faster than frames render, so their dirty windows are merged
+        # and drawn once when tk is idle
+        if self._dirty_window is None:
+            self._dirty_window = window
+            self._dirty_time = time.perf_counter()
+            self._flush_id = self.canvas.after_idle(self._flush_dirty)
         else:
-            composite = Image.new('RGBA', self.model.canvas.ws_zoom_size(), self.model.project.default_background_color)
-        for i in range(self.model.project.activeMask):
-            front = self._get_masked_image(i, show_all)
-            composite = Image.alpha_composite(composite, front)
-        return composite
-
-    def _comp_fg_image(self, show_all=False):
-        composite = self._get_masked_image(self.model.project.activeMask + 1, show_all)
-        for i in range(self.model.project.activeMask + 1, self.model.project.numMasks):
-            front = self._get_masked_image(i, show_all)
-            composite = Image.alpha_composite(composite, front)
-        return composite
+            left, top, right, bottom = self._dirty_window
+            self._dirty_window = (min(left, window[0]), min(top, window[1]),
+                                  max(right, window[2]), max(bottom, window[3]))
+
+        # a fast stroke can keep tk busy for a long time, so never hold a dirty region longer than a frame
+        if time.perf_counter() - self._dirty_time >= self._frame_interval:
+            self._flush_dirty()
+
+    def _flush_dirty(self):
+        window = self._dirty_window
+        self._clear_dirty()
+        if window:
+            self.render_canvas_region(window)
+
+    def _clear_dirty(self):
+        if self._flush_id is not None:
+            self.canvas.after_cancel(self._flush_id)
+        self._dirty_window = None
+        self._dirty_time = None
+        self._flush_id = None
+
+    def _viewport_window(self):
+        return (self.model.canvas.ms_zoom_left, self.model.canvas.ms_zoom_top,
+                self.model.canvas.ms_zoom_right, self.model.canvas.ms_zoom_bottom)
+
+    def _clip_to_viewport(self, window):
+        # returns the part of the level space window inside the viewport, or None if nothing is visible
+        left, top, right, bottom = window
+        vp_left, vp_top, vp_right, vp_bottom = self._viewport_window()
+        left = max(left, vp_left)
+        top = max(top, vp_top)
+        right = min(right, vp_right)
+        bottom = min(bottom, vp_bottom)
+        if left >= right or top >= bottom:
+            return None
+        return left, top, right, bottom
+
+    def _scroll_frame(self, old_window):
+        # shift the last frame by the camera delta and only composite the strips that scrolled into view
+        # returns False if the frame can not be reused and needs a full render
+        new_window = self._viewport_window()
+        if new_window == old_window:
+            # the camera moved less than one mask pixel, so the frame is unchanged
+            return self._frame is not None
+        left, top, right, bottom = new_window
+        old_left, old_top, old_right, old_bottom = old_window
+        if self._frame is None or (right - left, bottom - top) != (old_right - old_left, old_bottom - old_top):
+            return False
+        overlap = (max(left, old_left), max(top, old_top), min(right, old_right), min(bottom, old_bottom))
+        o_left, o_top, o_right, o_bottom = overlap
+        if o_left >= o_right or o_top >= o_bottom:
+            return False
+
+        with Tracer.frame("scroll_frame"):
+            self._scroll_overlap(new_window, old_window, overlap)
+        return True
+
+    def _scroll_overlap(self, new_window, old_window, overlap):
+        left, top, right, bottom = new_window
+        old_left, old_top, old_right, old_bottom = old_window
+        o_left, o_top, o_right, o_bottom = overlap
+        zoom = self.model.canvas.level_zoom
+        frame = np.empty_like(self._frame)
+        frame[(o_top - top) * zoom:(o_bottom - top) * zoom, (o_left - left) * zoom:(o_right - left) * zoom] = \
+            self._frame[(o_top - old_top) * zoom:(o_bottom - old_top) * zoom,
+                        (o_left - old_left) * zoom:(o_right - old_left) * zoom]
+
+        # full width strips above and below the overlap, then the strips left and right of it
+        strips = [(left, top, right, o_top), (left, o_bottom, right, bottom),
+                  (left, o_top, o_left, o_bottom), (o_right, o_top, right, o_bottom)]
+        for s_left, s_top, s_right, s_bottom in strips:
+            if s_left < s_right and s_top < s_bottom:
+                frame[(s_top - top) * zoom:(s_bottom - top) * zoom, (s_left - left) * zoom:(s_right - left) * zoom] = \
+                    self._render_window((s_left, s_top, s_right, s_bottom))
+
+        self._frame = frame
+        self._show_frame()
+
+    def _poll_export(self, export):
+        if not export.isDone:
+            self.canvas.after(self._export_poll_interval_ms, self._poll_export, export)
+        elif export.error:
+            raise export.error
+        elif self.model.isProjectLoaded:
+            self.model.set_comp_image_exported()
+
+    def _render_window(self, window):
+        # composite the layers at the resolution of the pyramid level, then zoom the finished frame once
+        # nearest neighbor zoom commutes with the per pixel blend, so this matches zooming every layer first
+        composite = self._tile_renderer.render(self.model.project, window, level=self.model.canvas.level)
+        return ZoomEngine.zoom_image(composite, self.model.canvas.level_zoom)
@@ -0,0 +1,125 @@
+"""
+Composites mask layers over an opaque background without building an RGBA image per layer.
+
+- masks are the visible layers bottom to top, as a (n, h, w) uint8 stack or a list of (h, w) uint8 crops
+- colors are a (n, 3) uint8 table of the layer colors, the alpha of each pixel comes from its mask
+- opaque mode uses the mask as alpha, transparent mode uses half of the mask as alpha
+- the result is an opaque (h, w, 3) uint8 rgb frame
+
+The blend is the integer math of PIL Image.alpha_composite over an opaque destination,
+so frames match folding the layers one at a time with PIL.
+
+- opaque mode: a full alpha pixel hides everything below it,
+    so one pass finds the topmost visible layer that covers each pixel and a palette lookup colors it
+- transparent mode: binary masks only have one alpha value,
+    so each layer is a 256 entry lookup table per color plane of the closed form blend, applied under its mask
+- partial alpha only comes from lossy masks, those few pixels are blended with the full formula
+"""
+
+import cv2 as cv
+import numpy as np
+from PIL import ImageColor
+
+
+class Compositor:
+    # palette index 0 is the background, so one uint8 pass can resolve 254 layers
+    max_pass_layers = 254
+
+    @staticmethod
+    def get_rgb(color):
+        return ImageColor.getrgb(color)[:3]
+
+    @staticmethod
+    def get_colors(colors):
+        return np.array([Compositor.get_rgb(color) for color in colors], dtype=np.uint8).reshape(-1, 3)
+
+    @staticmethod
+    def composite(background, masks, colors, opaque, size=None):
+        # background is an (h, w, 3) array, or anything that broadcasts to it like a single rgb color
+        # size (w, h) is only needed when there are no masks and the background is a single color
+        if size:
+            w, h = size
+        else:
+            h, w = masks[0].shape if len(masks) else np.shape(background)[:2]
+        frame = np.empty((h, w, 3), dtype=np.uint8)
+        frame[:] = background
+
+        step = Compositor.max_pass_layers
+        for start in range(0, len(masks), step):
+            if opaque:
+                Compositor._composite_opaque(frame, masks[start:start + step], colors[start:start + step])
+            else:
+                Compositor._composite_transparent(frame, masks[start:start + step], colors[start:start + step])
+        return frame
+
+    ###########################################################################
+    #
+    #  helpers
+    #
+    ###########################################################################
+
+    @staticmethod
+    def _composite_opaque(frame, masks, colors):
+        n = len(masks)
+        h, w = frame.shape[:2]
+
+        # top is the palette index of the topmost layer with full alpha, 0 where only the background is left
+        top = np.zeros((h, w), dtype=np.uint8)
+        for z in range(n):
+            _, covered = cv.threshold(masks[z], 254, z + 1, cv.THRESH_BINARY)
+            cv.max(top, covered, dst=top)
+
+        palette = np.zeros((256, 1, 3), dtype=np.uint8)
+        palette[1:n + 1, 0] = colors
+        colored = cv.LUT(cv.merge([top, top, top]), palette)
+        cv.copyTo(colored, top, frame)
+
+        # partial pixels blend over whatever is left below them, so only those above the topmost full layer count
+        for z in range(n):
+            partial = cv.inRange(masks[z], 1, 254)
+            if cv.countNonZero(partial):
+                selected = (partial != 0) & (top <= z)
+                Compositor._blend(frame, selected, colors[z], masks[z])
+
+    @staticmethod
+    def _composite_transparent(frame, masks, colors):
+        # a one channel lookup table is much faster than a three channel one, so blend the color planes separately
+        planes = cv.split(frame)
+        for z in range(len(masks)):
+            # only touch the bounding box of the mask
+            x, y, w, h = cv.boundingRect(masks[z])
+            if w == 0 or h == 0:
+                continue
+            mask = masks[z][y:y + h, x:x + w]
+
+            # binary masks are 255, so their alpha is 127 and the blend is a lookup table of the frame color
+            full = cv.inRange(mask, 254, 255)
+            partial = cv.inRange(mask, 2, 253)
+            has_partial = cv.countNonZero(partial) > 0
+            for c in range(3):
+                plane_box = planes[c][y:y + h, x:x + w]
+                lut = Compositor._blend_lut(colors[z][c], 127)
+                cv.copyTo(cv.LUT(plane_box, lut), full, plane_box)
+                if has_partial:
+                    Compositor._blend(plane_box, partial != 0, colors[z][c], mask // 2)
+        cv.merge(planes, dst=frame)
+
+    @staticmethod
+    def _blend_tmp(color, dst, a):
+        # closed form of PIL alpha_composite for a destination with alpha 255:
+        #   out = (color * a + dst * (255 - a)) / 255, rounded with the same 7 bits of precision
+        tmp = (np.asarray(color, dtype=np.uint32) * a + dst * (255 - a)) * 128 + (0x80 << 7)
+        return (((tmp >> 8) + tmp) >> 8) >> 7
+
+    @staticmethod
+    def _blend_lut(channel, a):
+        dst = np.arange(256, dtype=np.uint32)
+        return Compositor._blend_tmp(channel, dst, a).astype(np.uint8)
+
+    @staticmethod
+    def _blend(frame, selected, color, alpha):
+        # frame is either (h, w, 3) with an rgb color, or one (h, w) plane with one channel of the color
+        a = alpha[selected].astype(np.uint32)
+        if frame.ndim == 3:
+            a = a[:, None]
+        frame[selected] = Compositor._blend_tmp(color, frame[selected].astype(np.uint32), a)
@@ -0,0 +1,56 @@
+from tkinter import NW
+from PIL import ImageTk, Image
+
+from src.Tracer import Tracer
+
+
+class DisplaySurface:
+    # one canvas image item showing one PhotoImage that is updated in place
+    # the PhotoImage is only reallocated when the frame size changes
+    def __init__(self, canvas, tag):
+        self.canvas = canvas
+        self.tag = tag
+
+        # vars needing reset
+        self._photo = None
+        self._patch_photo = None
+        self._item = None
+
+    def reset(self):
+        # call after the canvas items were deleted
+        self._photo = None
+        self._patch_photo = None
+        self._item = None
+
+    def show(self, frame, x, y):
+        # show the whole (h, w, 3) rgb frame with its top left corner at canvas position (x, y)
+        image = Image.fromarray(frame)
+        if self._photo is not None and (self._photo.width(), self._photo.height()) == image.size:
+            with Tracer.span("photo_paste"):
+                self._photo.paste(image)
+            self.canvas.coords(self._item, x, y)
+            return
+
+        # set the canvas.image property, tk does not keep a reference to the PhotoImage
+        with Tracer.span("photo_create"):
+            self._photo = ImageTk.PhotoImage(image)
+        self.canvas.image = self._photo
+        if self._item is None:
+            self._item = self.canvas.create_image(x, y, image=self._photo, anchor=NW, tags=self.tag)
+
+            # keep the brush outline above the image
+            self.canvas.tag_lower(self._item)
+        else:
+            self.canvas.itemconfigure(self._item, image=self._photo)
+            self.canvas.coords(self._item, x, y)
+
+    def update_region(self, patch, x, y):
+        # copy the (h, w, 3) rgb patch into the shown image at image position (x, y)
+        # PhotoImage.paste always writes at the origin, so the patch goes through a second image and a tk copy
+        image = Image.fromarray(patch)
+        with Tracer.span("photo_copy"):
+            if self._patch_photo is None or (self._patch_photo.width(), self._patch_photo.height()) != image.size:
+                self._patch_photo = ImageTk.PhotoImage(image)
+            else:
+                self._patch_photo.paste(image)
+            self.canvas.tk.call(str(self._photo), 'copy', str(self._patch_photo), '-to', x, y)
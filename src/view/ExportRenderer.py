@@ -0,0 +1,135 @@
+"""
+Renders the full resolution composite of a project and streams it to a png file on a worker thread.
+
+- nothing depends on the canvas, the zoom or the window size, only on the project
+- the constructor snapshots the project on the calling thread, so the editor can keep painting during the export
+    layers that are not read yet are read by the export thread from the saved project
+- the image is composited in strips of rows, and each strip is compressed and written before the next one,
+    so only one strip of the rgba image is ever in memory
+- the png is written to a temp file that replaces the output only when it is complete
+"""
+
+import os
+import struct
+import threading
+import zlib
+import numpy as np
+
+from src.Tracer import Tracer
+from src.model.DiskMask import DiskMask
+from src.view.Compositor import Compositor
+
+
+class PngWriter:
+    # minimal streaming png encoder for 8 bit rgba rows, no filtering
+    def __init__(self, file, width, height, idat_size=1 << 16):
+        self._file = file
+        self._width = width
+        self._idat_size = idat_size
+        self._compressor = zlib.compressobj()
+        self._pending = []
+        self._pending_size = 0
+
+        file.write(b'\x89PNG\r\n\x1a\n')
+        self._write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+
+    def write_rows(self, rgba):
+        # rgba is an (h, width, 4) uint8 array, every row starts with filter type 0
+        h = rgba.shape[0]
+        rows = np.zeros((h, 1 + self._width * 4), dtype=np.uint8)
+        rows[:, 1:] = rgba.reshape(h, -1)
+        self._add_compressed(self._compressor.compress(rows.tobytes()))
+
+    def close(self):
+        self._add_compressed(self._compressor.flush())
+        self._flush_idat()
+        self._write_chunk(b'IEND', b'')
+
+    ###########################################################################
+    #
+    #  helpers
+    #
+    ###########################################################################
+
+    def _add_compressed(self, data):
+        if data:
+            self._pending.append(data)
+            self._pending_size += len(data)
+        if self._pending_size >= self._idat_size:
+            self._flush_idat()
+
+    def _flush_idat(self):
+        if self._pending_size:
+            self._write_chunk(b'IDAT', b''.join(self._pending))
+            self._pending = []
+            self._pending_size = 0
+
+    def _write_chunk(self, chunk_type, data):
+        self._file.write(struct.pack('>I', len(data)))
+        self._file.write(chunk_type)
+        self._file.write(data)
+        self._file.write(struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+
+
+class ExportRenderer:
+    def __init__(self, project, strip_height=256):
+        self.strip_height = strip_height
+        self.isDone = False
+        self.error = None
+
+        # every layer is exported, hidden or not
+        # a layer not read yet equals its saved mask, so it is read on the export thread instead of copied here
+        layers = [project.get_layer_by_z(z) for z in range(project.numMasks)]
+        self._masks = [DiskMask.copy(layer.cvMask) if layer.is_loaded() else project.get_mask_reader(k)
+                       for k, layer in zip(project.layerKeys, layers)]
+        self._colors = Compositor.get_colors([layer.color for layer in layers])
+        self._opaque = project.maskOpaque
+        self._size = project.imgSize
+        if project.cvBackgroundImage is not None:
+            self._background = project.cvBackgroundImage[..., :3].copy()
+        else:
+            self._background = np.array(Compositor.get_rgb(project.default_background_color), dtype=np.uint8)
+        self._thread = None
+
+    def start(self, file_path):
+        self._thread = threading.Thread(target=self._run, args=(file_path,), name='ExportRenderer', daemon=True)
+        self._thread.start()
+
+    def write(self, file_path):
+        # export on the calling thread
+        self._masks = [mask() if callable(mask) else mask for mask in self._masks]
+        w, h = self._size
+        temp_path = file_path + '.tmp'
+        with open(temp_path, 'wb') as file:
+            writer = PngWriter(file, w, h)
+            for top in range(0, h, self.strip_height):
+                with Tracer.span("export_strip"):
+                    rgba = self.render_strip(top, min(h, top + self.strip_height))
+                with Tracer.span("export_write"):
+                    writer.write_rows(rgba)
+            writer.close()
+        os.replace(temp_path, file_path)
+
+    def render_strip(self, top, bottom):
+        # (bottom - top, w, 4) rgba rows of the composite
+        w = self._size[0]
+        background = self._background[top:bottom] if self._background.ndim == 3 else self._background
+        rgb = Compositor.composite(background, [mask[top:bottom] for mask in self._masks], self._colors,
+                                   self._opaque, (w, bottom - top))
+        rgba = np.empty((bottom - top, w, 4), dtype=np.uint8)
+        rgba[..., :3] = rgb
+        rgba[..., 3] = 255
+        return rgba
+
+    ###########################################################################
+    #
+    #  helpers
+    #
+    ###########################################################################
+
+    def _run(self, file_path):
+        try:
+            self.write(file_path)
+        except Exception as e:
+            self.error = e
+        self.isDone = True
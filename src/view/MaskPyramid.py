@@ -0,0 +1,60 @@
+import cv2 as cv
+import numpy as np
+
+from src.Tracer import Tracer
+from src.model.DiskMask import DiskMask
+
+
+class MaskPyramid:
+    # levels[0] is the full size image, levels[k] is scaled down by 2 ** k with a 2x2 box filter
+    # odd sizes round up, the last row or column is averaged with a copy of itself
+    # levels are built on first use and then kept up to date by update
+    def __init__(self, image):
+        self.levels = [image]
+
+    def get_level(self, level):
+        while len(self.levels) <= level:
+            with Tracer.span("pyramid_build"):
+                self.levels.append(self._build_level(self.levels[-1]))
+        return self.levels[level]
+
+    @staticmethod
+    def downsample(image):
+        h, w = image.shape[:2]
+        if h % 2 or w % 2:
+            image = cv.copyMakeBorder(image, 0, h % 2, 0, w % 2, cv.BORDER_REPLICATE)
+        # an exact half size INTER_AREA resize is the rounded mean of each 2x2 block
+        return cv.resize(image, ((w + 1) // 2, (h + 1) // 2), interpolation=cv.INTER_AREA)
+
+    def update(self, window):
+        # the full size image changed inside the window (left, top, right, bottom)
+        # recompute only the blocks of the built levels that cover it
+        if len(self.levels) == 1:
+            return
+        left, top, right, bottom = window
+        with Tracer.span("pyramid_update"):
+            for level in range(1, len(self.levels)):
+                src = self.levels[level - 1]
+                left, top, right, bottom = left // 2, top // 2, (right + 1) // 2, (bottom + 1) // 2
+                self.levels[level][top:bottom, left:right] = \
+                    self.downsample(src[top * 2:bottom * 2, left * 2:right * 2])
+
+    ###########################################################################
+    #
+    #  helpers
+    #
+    ###########################################################################
+
+    @staticmethod
+    def _build_level(image):
+        # the next level of a mask on disk is built in strips of rows into a scratch file, never whole in memory
+        # strips have an even number of rows, so every strip but the last maps to whole rows of the level
+        if not isinstance(image, np.memmap):
+            return MaskPyramid.downsample(image)
+        h, w = image.shape[:2]
+        level = DiskMask.zeros_like(image, ((h + 1) // 2, (w + 1) // 2))
+        rows = DiskMask.stripRows
+        for top in range(0, h, rows):
+            strip = MaskPyramid.downsample(image[top:top + rows])
+            level[top // 2:top // 2 + strip.shape[0]] = strip
+        return level
@@ -0,0 +1,219 @@
+"""
+Mask space is split into fixed size tiles, and the viewport is assembled from cached tile composites.
+
+- every layer has an occupancy flag per tile, set when the tile has any nonzero mask pixel
+- every layer has a version per tile, bumped only for the tiles an edit touched
+- a tile composite is cached under its signature:
+    the tile versions of the layers that are shown and occupy the tile, in z order, and the mask opacity
+- a tile that no shown layer occupies is skipped entirely and copied straight from the background
+
+Zoom levels below 1 render from a pyramid of every mask and of the background, level k is scaled down by 2 ** k.
+Windows and tiles are in the space of the rendered level, so a frame always costs about its own pixel count.
+- a level k tile covers a block of 2 ** k by 2 ** k level 0 tiles
+    its occupancy and version are the max over that block, so they never need their own bookkeeping
+- an edit recomputes only the pyramid blocks under the edited window
+"""
+
+from collections import OrderedDict
+from weakref import WeakKeyDictionary
+import itertools
+import cv2 as cv
+import numpy as np
+
+from src.Tracer import Tracer
+from src.view.Compositor import Compositor
+from src.view.MaskPyramid import MaskPyramid
+
+# tile versions come from one global counter, so a tile signature is never reused for different pixels
+_tile_versions = itertools.count()
+
+
+class LayerTiles:
+    def __init__(self, layer, tile_size):
+        self.maskVersion = layer.maskVersion
+        self.occupied = TileRenderer.get_occupancy(layer.cvMask, tile_size)
+        self.tileVersions = np.full(self.occupied.shape, next(_tile_versions), dtype=np.int64)
+        self.pyramid = MaskPyramid(layer.cvMask)
+
+    def get_level(self, level):
+        # (occupied, tileVersions) of the tiles of a pyramid level
+        if level == 0:
+            return self.occupied, self.tileVersions
+        return TileRenderer.reduce_tiles(self.occupied, level), TileRenderer.reduce_tiles(self.tileVersions, level)
+
+
+class TileRenderer:
+    def __init__(self, tile_size=128, cache_limit_bytes=256 * 1024 * 1024):
+        self.tile_size = tile_size
+        self._cache_limit_bytes = cache_limit_bytes
+        self._cache_bytes = 0
+        self._cache = OrderedDict()
+        self._layer_tiles = WeakKeyDictionary()
+        self._background = None
+
+    def reset(self):
+        self._cache.clear()
+        self._cache_bytes = 0
+        self._layer_tiles.clear()
+        self._background = None
+
+    @staticmethod
+    def get_occupancy(mask, tile_size):
+        # (rows, cols) bool array, True where the tile has any nonzero pixel
+        h, w = mask.shape[:2]
+        return np.array([[cv.countNonZero(mask[top:top + tile_size, left:left + tile_size]) > 0
+                          for left in range(0, w, tile_size)]
+                         for top in range(0, h, tile_size)], dtype=bool).reshape(-1, (w + tile_size - 1) // tile_size)
+
+    @staticmethod
+    def reduce_tiles(tiles, level):
+        # max over every 2 ** level by 2 ** level block of a level 0 tile array
+        step = 1 << level
+        rows = np.maximum.reduceat(tiles, np.arange(0, tiles.shape[0], step), axis=0)
+        return np.maximum.reduceat(rows, np.arange(0, tiles.shape[1], step), axis=1)
+
+    def get_tile_range(self, window):
+        # tiles (col_first, row_first, col_end, row_end) that intersect the window
+        left, top, right, bottom = window
+        t = self.tile_size
+        return left // t, top // t, (right + t - 1) // t, (bottom + t - 1) // t
+
+    def mask_edited(self, layer, window):
+        # an edit changed the pixels of layer inside the mask space window
+        # only the tiles it touched get a new occupancy flag and a new version
+        tiles = self._layer_tiles.get(layer)
+        if tiles is None:
+            return
+        h, w = layer.cvMask.shape[:2]
+        left, top, right, bottom = window
+        window = (max(0, left), max(0, top), min(w, right), min(h, bottom))
+        tiles.maskVersion = layer.maskVersion
+        if window[0] >= window[2] or window[1] >= window[3]:
+            return
+        col_first, row_first, col_end, row_end = self.get_tile_range(window)
+        t = self.tile_size
+        sub_mask = layer.cvMask[row_first * t:row_end * t, col_first * t:col_end * t]
+        tiles.occupied[row_first:row_end, col_first:col_end] = self.get_occupancy(sub_mask, t)
+        tiles.tileVersions[row_first:row_end, col_first:col_end] = next(_tile_versions)
+        tiles.pyramid.update(window)
+
+    def render(self, project, window, level=0):
+        # (h, w, 3) rgb composite of the window in the space of the pyramid level
+        with Tracer.span("render_tiles"):
+            left, top, right, bottom = window
+            frame = np.empty((bottom - top, right - left, 3), dtype=np.uint8)
+
+            self._drop_unloaded_layers()
+
+            layers = [project.get_layer_by_z(z) for z in range(project.numMasks)]
+            layers = [layer for layer in layers if layer.isVisible]
+            layer_tiles = [self._get_layer_tiles(layer) for layer in layers]
+            level_tiles = [tiles.get_level(level) for tiles in layer_tiles]
+            colors = Compositor.get_colors([layer.color for layer in layers])
+
+            scale = 1 << level
+            mask_w, mask_h = -(-project.imgSize[0] // scale), -(-project.imgSize[1] // scale)
+            t = self.tile_size
+            col_first, row_first, col_end, row_end = self.get_tile_range(window)
+            for row in range(row_first, row_end):
+                for col in range(col_first, col_end):
+                    tile_window = (col * t, row * t, min((col + 1) * t, mask_w), min((row + 1) * t, mask_h))
+
+                    # the part of the tile inside the window, in tile space and in frame space
+                    x0 = max(left, tile_window[0])
+                    y0 = max(top, tile_window[1])
+                    x1 = min(right, tile_window[2])
+                    y1 = min(bottom, tile_window[3])
+                    frame_box = frame[y0 - top:y1 - top, x0 - left:x1 - left]
+
+                    shown = [i for i in range(len(layers)) if level_tiles[i][0][row, col]]
+                    if not shown:
+                        frame_box[:] = self._get_background(project, (x0, y0, x1, y1), level)
+                        continue
+
+                    tile = self._get_tile(project, tile_window, level, shown, layers, layer_tiles, level_tiles,
+                                          colors, row, col)
+                    tile_left, tile_top = tile_window[:2]
+                    frame_box[:] = tile[y0 - tile_top:y1 - tile_top, x0 - tile_left:x1 - tile_left]
+            return frame
+
+    def render_region(self, project, window, level=0):
+        # (h, w, 3) rgb composite of a small window, like a dirty rectangle, without the tile cache
+        # a tile around a brush stroke is many times larger than the stroke, so only the window is composited
+        # using the layers that occupy any of its tiles
+        left, top, right, bottom = window
+        with Tracer.span("render_region"):
+            masks, colors = self._get_window_layers(project, window, level)
+            return Compositor.composite(self._get_background(project, window, level), masks, colors,
+                                        project.maskOpaque, (right - left, bottom - top))
+
+    ###########################################################################
+    #
+    #  helpers
+    #
+    ###########################################################################
+
+    def _get_layer_tiles(self, layer):
+        # masks changed without a known region (a new or restored layer) are rebuilt whole,
+        # and so are masks that were unloaded and read again
+        tiles = self._layer_tiles.get(layer)
+        if tiles is None or tiles.maskVersion != layer.maskVersion or tiles.pyramid.levels[0] is not layer.cvMask:
+            tiles = LayerTiles(layer, self.tile_size)
+            self._layer_tiles[layer] = tiles
+        return tiles
+
+    def _drop_unloaded_layers(self):
+        # the tiles of unloaded layers would keep their masks in memory
+        for layer in [layer for layer in self._layer_tiles.keys() if not layer.is_loaded()]:
+            del self._layer_tiles[layer]
+
+    def _get_window_layers(self, project, window, level):
+        # the mask crops and colors of the visible layers that occupy any tile of the window, bottom to top
+        left, top, right, bottom = window
+        col_first, row_first, col_end, row_end = self.get_tile_range(window)
+        self._drop_unloaded_layers()
+        masks = []
+        colors = []
+        for z in range(project.numMasks):
+            layer = project.get_layer_by_z(z)
+            if not layer.isVisible:
+                continue
+            tiles = self._get_layer_tiles(layer)
+            if tiles.get_level(level)[0][row_first:row_end, col_first:col_end].any():
+                masks.append(tiles.pyramid.get_level(level)[top:bottom, left:right])
+                colors.append(layer.color)
+        return masks, Compositor.get_colors(colors)
+
+    def _get_background(self, project, window, level=0):
+        left, top, right, bottom = window
+        if project.cvBackgroundImage is None:
+            return np.array(Compositor.get_rgb(project.default_background_color), dtype=np.uint8)
+        if level == 0:
+            return project.cvBackgroundImage[top:bottom, left:right, :3]
+        if self._background is None or self._background.levels[0] is not project.cvBackgroundImage:
+            self._background = MaskPyramid(project.cvBackgroundImage)
+        return self._background.get_level(level)[top:bottom, left:right, :3]
+
+    def _get_tile(self, project, tile_window, level, shown, layers, layer_tiles, level_tiles, colors, row, col):
+        # the colors are part of the signature, so a color change never invalidates the cached masks
+        key = (level, row, col, project.maskOpaque,
+               tuple((int(level_tiles[i][1][row, col]), layers[i].color) for i in shown))
+        tile = self._cache.get(key)
+        if tile is not None:
+            self._cache.move_to_end(key)
+            return tile
+
+        left, top, right, bottom = tile_window
+        with Tracer.span("composite_tile"):
+            masks = [layer_tiles[i].pyramid.get_level(level)[top:bottom, left:right] for i in shown]
+            tile = Compositor.composite(self._get_background(project, tile_window, level), masks, colors[shown],
+                                        project.maskOpaque, (right - left, bottom - top))
+        self._cache[key] = tile
+        self._cache_bytes += tile.nbytes
+        self._evict()
+        return tile
+
+    def _evict(self):
+        while self._cache_bytes > self._cache_limit_bytes and len(self._cache) > 1:
+            _, tile = self._cache.popitem(last=False)
+            self._cache_bytes -= tile.nbytes
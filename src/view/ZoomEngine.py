@@ -0,0 +1,15 @@
+import cv2 as cv
+
+from src.Tracer import Tracer
+
+
+class ZoomEngine:
+    @staticmethod
+    def zoom_image(img, zoom):
+        # nearest neighbor upscale by an integer zoom factor
+        # gives the same pixels as np.kron with a ones block, without the multiply and the temp arrays
+        if zoom <= 1:
+            return img
+        h, w = img.shape[:2]
+        with Tracer.span("zoom"):
+            return cv.resize(img, (w * zoom, h * zoom), interpolation=cv.INTER_NEAREST)